@@ -0,0 +1,258 @@
+# end-to-end benchmarks for mqn, run against an in-process stub broker
+
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from constants import default_config
+from engine import MqnEngine
+from sinks import Sink
+from stubbroker import StubBroker
+
+# memory is measured with tracemalloc where it's available (python 3), and peak rss otherwise
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+try:
+    import resource
+except ImportError: # windows
+    resource = None
+
+
+class BalloonSink(Sink):
+    """Stands in for the tray's balloons, recording when each notification would have been shown."""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.shown = {} # title -> time shown
+
+    def notify(self, title, message, topic=None):
+        now = time.time()
+        with self.lock:
+            self.shown[title] = now
+
+    def count(self):
+        with self.lock:
+            return len(self.shown)
+
+
+def percentile(values, p):
+    """Return the p percentile (0 to 100) of values, or None if there aren't any."""
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+def memory_usage():
+    """Return the memory in use, in bytes, or None if it can't be measured here."""
+    if tracemalloc != None and tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    if resource != None:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage if sys.platform == 'darwin' else usage * 1024 # kilobytes everywhere but macos
+    return None
+
+def wait_for(condition, timeout, interval=0.001):
+    """Poll condition until it returns True or timeout seconds pass. Returns whether it did."""
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() >= deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+class Benchmark(object):
+    """Runs a real MqnEngine against a StubBroker on the loopback interface, with a BalloonSink in place of the tray.
+Messages go through everything a real one does (paho, the network loop, on_notification's topic matching and decoding, the dispatch queue), and are shown by calling dispatch_pending every dispatch_interval milliseconds, like the tray's timer does.
+Coalescing is disabled (every notification in a burst is shown on its own) so each message's latency can be measured.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.sink = BalloonSink()
+        self.published = {} # title -> time published
+        self.seq = 0
+        self.stopping = False
+
+    def config(self):
+        a = self.args
+        lines = [
+            "[mqn]",
+            "quiet = true",
+            "watch_config = false",
+            "dispatch_interval = {}".format(a.dispatch_interval),
+            "queue_size = {}".format(a.messages * a.bursts + 1),
+            "max_balloons = {}".format(a.messages),
+            "coalesce_threshold = {}".format(a.messages + 1),
+            "dedupe = {}".format("true" if a.dedupe else "false"),
+            "dedupe_path = {}".format(json.dumps(os.path.join(self.dir, "seen.sqlite"))),
+            "history_path = {}".format(json.dumps(os.path.join(self.dir, "history.sqlite"))),
+            "[mqtt]",
+            "host = {}".format(json.dumps(self.broker.host)),
+            "port = {}".format(self.broker.port),
+            "min_reconnect_delay = {}".format(a.reconnect_delay),
+            "max_reconnect_delay = {}".format(a.reconnect_delay * 10),
+        ]
+        for i in range(a.topics):
+            lines.append("[topic.\"bench/{}\"]".format(i))
+            lines.append("qos = {}".format(a.qos))
+        return "\n".join(lines) + "\n"
+
+    def start(self):
+        self.dir = tempfile.mkdtemp(prefix="mqn-bench-")
+        self.broker = StubBroker().start()
+        with open(os.path.join(self.dir, "mqn.conf"), 'w') as f:
+            f.write(self.config())
+        # the engine looks for mqn.conf in the working directory first
+        self.old_cwd = os.getcwd()
+        os.chdir(self.dir)
+        self.engine = MqnEngine([self.sink])
+        self.dispatcher = threading.Thread(target=self.dispatch, name="mqn bench dispatch")
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+        if not wait_for(self.subscribed, self.args.timeout):
+            raise RuntimeError("mqn didn't connect and subscribe to the stub broker within {} seconds".format(self.args.timeout))
+
+    def stop(self):
+        self.stopping = True
+        self.engine.shutdown()
+        self.broker.stop()
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def dispatch(self):
+        interval = self.args.dispatch_interval / 1000.0
+        while not self.stopping:
+            self.engine.dispatch_pending()
+            time.sleep(interval)
+
+    def subscribed(self):
+        return self.engine.mqtt_connected and self.engine.subscription_pipeline.time_to_subscribed != None
+
+    def payload(self, title):
+        m = {"type": "notification", "title": title, "message": "benchmark message", "padding": ""}
+        size = len(json.dumps(m))
+        m['padding'] = "x" * max(0, self.args.payload_size - size)
+        return json.dumps(m)
+
+    def burst(self):
+        """Publish one burst of messages, spread across the topics at the configured rate, and wait for them to be shown. Returns a dict of results."""
+        a = self.args
+        received_before = self.engine.dispatch_queue.received
+        titles = []
+        start = time.time()
+        for i in range(a.messages):
+            if a.rate > 0: # pace publishing, rather than sleeping a fixed amount between messages and drifting
+                delay = start + float(i) / a.rate - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            title = "bench {}".format(self.seq)
+            self.seq += 1
+            titles.append(title)
+            self.published[title] = time.time()
+            self.broker.publish("bench/{}".format(i % a.topics), self.payload(title), a.qos)
+        published = time.time()
+        received = wait_for(lambda: self.engine.dispatch_queue.received - received_before >= a.messages, a.timeout)
+        received_at = time.time()
+        wait_for(lambda: all(t in self.sink.shown for t in titles), a.timeout)
+        with self.sink.lock:
+            shown = [(t, self.sink.shown[t]) for t in titles if t in self.sink.shown]
+        latencies = [s - self.published[t] for t, s in shown]
+        last = max([s for t, s in shown] or [published])
+        return {
+            "messages": a.messages,
+            "shown": len(shown),
+            "publish_seconds": published - start,
+            "receive_rate": a.messages / max(received_at - start, 1e-9) if received else None,
+            "show_rate": len(shown) / max(last - start, 1e-9),
+            "latencies": latencies,
+        }
+
+    def reconnect(self):
+        """Cut mqn off from the broker and return how long it takes to be connected and subscribed again, or None if it didn't recover in time."""
+        start = time.time()
+        self.broker.drop_clients()
+        if not wait_for(lambda: not self.subscribed(), self.args.timeout):
+            return None
+        if not wait_for(self.subscribed, self.args.timeout):
+            return None
+        return time.time() - start
+
+    def run(self):
+        if tracemalloc != None:
+            tracemalloc.start()
+        self.start()
+        try:
+            memory_before = memory_usage()
+            bursts = []
+            for i in range(self.args.bursts):
+                bursts.append(self.burst())
+            memory_after = memory_usage()
+            recoveries = [self.reconnect() for i in range(self.args.reconnects)]
+        finally:
+            self.stop()
+            if tracemalloc != None:
+                tracemalloc.stop()
+        latencies = [l for b in bursts for l in b['latencies']]
+        receive_rates = [b['receive_rate'] for b in bursts if b['receive_rate'] != None]
+        recovered = [r for r in recoveries if r != None]
+        return {
+            "messages": sum(b['messages'] for b in bursts),
+            "shown": sum(b['shown'] for b in bursts),
+            "receive_rate": sum(receive_rates) / len(receive_rates) if receive_rates else None,
+            "show_rate": sum(b['show_rate'] for b in bursts) / len(bursts) if bursts else None,
+            "latency_p50": percentile(latencies, 50),
+            "latency_p99": percentile(latencies, 99),
+            "latency_max": max(latencies) if latencies else None,
+            "memory_growth": memory_after - memory_before if memory_before != None and memory_after != None else None,
+            "reconnects": len(recoveries),
+            "reconnects_failed": len(recoveries) - len(recovered),
+            "recovery_p50": percentile(recovered, 50),
+            "recovery_max": max(recovered) if recovered else None,
+        }
+
+
+def report(results):
+    """Format the results of Benchmark.run() for a person to read."""
+    def num(key, fmt, scale=1):
+        return "n/a" if results[key] == None else fmt.format(results[key] * scale)
+    lines = [
+        "messages shown: {} of {}".format(results['shown'], results['messages']),
+        "throughput: {} received, {} shown".format(num('receive_rate', "{:.0f}/s"), num('show_rate', "{:.0f}/s")),
+        "latency (published to shown): p50 {}, p99 {}, max {}".format(num('latency_p50', "{:.1f} ms", 1000), num('latency_p99', "{:.1f} ms", 1000), num('latency_max', "{:.1f} ms", 1000)),
+        "memory growth: {}".format(num('memory_growth', "{:.0f} KiB", 1 / 1024.0)),
+        "reconnect recovery: p50 {}, max {} ({} of {} failed)".format(num('recovery_p50', "{:.0f} ms", 1000), num('recovery_max', "{:.0f} ms", 1000), results['reconnects_failed'], results['reconnects']),
+    ]
+    return "\n".join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="benchmark", description="Measure how quickly mqn shows notifications, against an in-process mqtt broker.")
+    parser.add_argument("--messages", type=int, default=1000, help="messages per burst (default: %(default)s)")
+    parser.add_argument("--bursts", type=int, default=3, help="number of bursts (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=0, help="messages per second within a burst; 0 publishes as fast as possible (default: %(default)s)")
+    parser.add_argument("--topics", type=int, default=10, help="number of topics messages are spread across (default: %(default)s)")
+    parser.add_argument("--payload-size", type=int, default=256, help="approximate size of each message in bytes (default: %(default)s)")
+    parser.add_argument("--qos", type=int, default=0, choices=(0, 1, 2), help="qos to publish and subscribe with (default: %(default)s)")
+    parser.add_argument("--dedupe", action="store_true", help="record messages in the seen message store, as mqn does by default")
+    parser.add_argument("--dispatch-interval", type=int, default=default_config['mqn']['dispatch_interval'], help="milliseconds between showing queued notifications (default: %(default)s)")
+    parser.add_argument("--reconnects", type=int, default=3, help="number of times to cut the connection and time the recovery (default: %(default)s)")
+    parser.add_argument("--reconnect-delay", type=float, default=0.1, help="min_reconnect_delay to run mqn with, in seconds (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=30, help="seconds to wait for a burst or reconnect before giving up on it (default: %(default)s)")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args(argv)
+    if args.messages < 1 or args.topics < 1:
+        parser.error("--messages and --topics must be at least 1")
+    results = Benchmark(args).run()
+    if args.json:
+        print(json.dumps(results, sort_keys=True))
+    else:
+        print(report(results))
+    return 0 if results['shown'] == results['messages'] and results['reconnects_failed'] == 0 else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
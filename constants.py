@@ -5,14 +5,47 @@ default_config = {
   "quiet": True,\
   "autoconnect": True,\
   "directed_notifications": False,\
+  "queue_size": 500,\
+  "dispatch_interval": 500,\
+  "max_balloons": 5,\
+  "coalesce_threshold": 3,\
+  "rate_limit": 0,\
+  "burst": 3,\
+  "dedupe": True,\
+  "dedupe_path": "auto",\
+  "dedupe_max_entries": 10000,\
+  "dedupe_ttl": 86400,\
+  "watch_config": True,\
+  "watch_interval": 2,\
+  "subscribe_chunk_size": 100,\
+  "subscribe_window": 4,\
+  "subscribe_timeout": 30,\
+  "subscribe_retries": 5,\
+  "max_payload_size": 65536,\
+  "max_decompressed_size": 65536,\
+  "metrics_file": "",\
+  "metrics_socket": "",\
+  "metrics_interval": 15,\
+  "history": True,\
+  "history_path": "auto",\
+  "history_max_entries": 100000,\
+  "history_recent": 10,\
+  "suppress_cache_size": 1000,\
+  "icon_cache_size": 100,\
+  "icon_cache_path": "",\
+  "icon_disk_entries": 1000,\
+  "max_icon_size": 65536,\
  },\
  "mqtt" : {
   "port" : 1883,\
   "keepalive" : 60,\
+  "client_id" : "auto",\
+  "clean_session" : False,\
   "min_reconnect_delay" : 1,\
   "max_reconnect_delay" : 120,\
   "ssl" : False,\
   "ca_certs" : "auto",\
+  "fallback_hosts" : [],\
  }
 }
 
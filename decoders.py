@@ -0,0 +1,101 @@
+# notification payload decoders
+
+import json
+import zlib
+
+# msgpack and cbor are optional; topics can only use those formats if the module is installed
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+try:
+    import cbor2
+except ImportError:
+    cbor2 = None
+
+
+class DecodeError(ValueError):
+    """Raised when a payload looked like a notification but couldn't be decoded."""
+    pass
+
+
+def load_json(payload):
+    return json.loads(payload)
+
+def load_msgpack(payload):
+    return msgpack.unpackb(payload, raw=False)
+
+def load_cbor(payload):
+    return cbor2.loads(payload)
+
+def json_map(first):
+    return first == b'{'
+
+def msgpack_map(first):
+    b = bytearray(first)[0]
+    return 0x80 <= b <= 0x8f or b in (0xde, 0xdf) # fixmap, map 16, map 32
+
+def cbor_map(first):
+    return 0xa0 <= bytearray(first)[0] <= 0xbf # major type 5
+
+# format name -> (function that decodes a payload, test of the payload's first byte for a map/object, module it needs)
+formats = {
+    "json": (load_json, json_map, json),
+    "msgpack": (load_msgpack, msgpack_map, msgpack),
+    "cbor": (load_cbor, cbor_map, cbor2),
+}
+
+# compression name -> the wbits argument zlib needs to read it
+compressions = {
+    "zlib": zlib.MAX_WBITS,
+    "gzip": 16 + zlib.MAX_WBITS,
+}
+
+
+class Decoder(object):
+    """Turns a topic's message payloads into notification dicts.
+Payloads are first checked cheaply: anything over max_payload_size bytes, anything whose first byte can't start a map (a json object, say), and anything that doesn't contain the bytes "notification" at all (which every notification's type field does, in all of these formats) is rejected without being parsed. This keeps large telemetry messages on wildcard subscriptions from costing a full parse.
+Compressed payloads are decompressed first, up to max_decompressed_size bytes; anything that would be larger is rejected.
+    """
+    def __init__(self, format="json", compression="none", max_payload_size=65536, max_decompressed_size=65536):
+        if format not in formats:
+            raise ValueError("unknown payload format \"{}\" (must be one of {})".format(format, ", ".join(sorted(formats.keys()))))
+        if formats[format][2] == None:
+            raise ValueError("the {} payload format needs the {} module, which isn't installed".format(format, "cbor2" if format == "cbor" else format))
+        if compression != "none" and compression not in compressions:
+            raise ValueError("unknown payload compression \"{}\" (must be none, {})".format(compression, ", ".join(sorted(compressions.keys()))))
+        self.format = format
+        self.compression = compression
+        self.load, self.is_map = formats[format][:2]
+        self.max_payload_size = max_payload_size
+        self.max_decompressed_size = max_decompressed_size
+        # the quotes are part of it for json; the other formats prefix strings with their length instead
+        self.marker = b'"notification"' if format == "json" else b'notification'
+
+    def decompress(self, payload):
+        d = zlib.decompressobj(compressions[self.compression])
+        try:
+            data = d.decompress(payload, self.max_decompressed_size)
+        except zlib.error as e:
+            raise DecodeError("couldn't decompress payload: {}".format(e))
+        if d.unconsumed_tail:
+            raise DecodeError("payload decompresses to more than {} bytes".format(self.max_decompressed_size))
+        return data
+
+    def decode(self, payload):
+        """Return the decoded payload, or None if it can't be a notification. Raises DecodeError if it looked like one but couldn't be decoded."""
+        if len(payload) > self.max_payload_size:
+            return None
+        if self.compression != "none":
+            payload = self.decompress(payload)
+        if self.format == "json":
+            payload = payload.lstrip()
+        if not payload or not self.is_map(payload[:1]) or self.marker not in payload:
+            return None
+        try:
+            m = self.load(payload)
+        except Exception as e: # each library has its own exceptions for malformed data
+            raise DecodeError("couldn't decode {} payload: {}".format(self.format, e))
+        if not isinstance(m, dict):
+            return None
+        return m
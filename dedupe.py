@@ -0,0 +1,62 @@
+# a persistent store of recently seen messages
+
+import hashlib
+import sqlite3
+import threading
+import time
+
+
+def message_key(topic, payload):
+    """Return a key identifying a message by its topic and payload."""
+    if not isinstance(topic, bytes):
+        topic = topic.encode('utf-8')
+    return hashlib.sha1(topic + b'\0' + payload).hexdigest()
+
+
+class SeenStore(object):
+    """Remembers which messages have already been shown, in a small sqlite database, so redelivered messages can be recognized even after mqn restarts.
+Lookups go through the table's primary key index. Entries older than ttl seconds are forgotten, and the table is kept to about max_entries rows by evicting the oldest.
+    """
+    def __init__(self, path, max_entries=10000, ttl=86400):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False) # used from the mqtt network thread, and closed from wherever shutdown happens
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal") # durable enough for this, without an fsync for every message
+        self.db.execute("create table if not exists seen (key text primary key, seen real not null)")
+        self.db.execute("create index if not exists seen_time on seen (seen)")
+        self.db.commit()
+        self.prune_every = max(1, max_entries // 10)
+        self.adds = 0
+
+    def seen(self, key, now=None):
+        """Return True if key was recorded within the last ttl seconds."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            row = self.db.execute("select seen from seen where key=?", (key,)).fetchone()
+        return row != None and now - row[0] < self.ttl
+
+    def add(self, key, now=None):
+        """Record key as seen."""
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.db.execute("insert or replace into seen (key, seen) values (?, ?)", (key, now))
+            self.db.commit()
+            self.adds += 1
+            if self.adds >= self.prune_every:
+                self.adds = 0
+                self._prune(now)
+
+    def _prune(self, now):
+        self.db.execute("delete from seen where seen < ?", (now - self.ttl,))
+        excess = self.db.execute("select count(*) from seen").fetchone()[0] - self.max_entries
+        if excess > 0:
+            self.db.execute("delete from seen where key in (select key from seen order by seen limit ?)", (excess,))
+        self.db.commit()
+
+    def close(self):
+        with self.lock:
+            self.db.close()
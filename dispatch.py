@@ -0,0 +1,126 @@
+# notification dispatch queue
+
+import threading
+import time
+from collections import deque, OrderedDict
+
+
+class RateLimiter(object):
+    """A simple token bucket.
+Rate is the number of notifications allowed per minute, burst is how many can be shown back-to-back before the rate applies.
+    """
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate) / 60.0 # tokens per second
+        self.burst = max(1, burst)
+        self.tokens = float(self.burst)
+        self.last = time.time()
+
+    def take(self, now=None):
+        """Take a token if one is available, returning True if it was."""
+        if now is None:
+            now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+class DispatchQueue(object):
+    """A bounded, thread-safe queue sitting between the mqtt network thread and whatever shows notifications.
+The network thread only calls put(); the UI thread periodically calls drain(), which groups what's queued by subscription, coalesces bursts into a single summary notification, and applies per-subscription rate limits.
+Notifications held back by a rate limit (or because a batch was full) aren't lost; they're shown with that subscription's next batch, as they are if there are still fewer than coalesce_threshold of them, or in a summary if not.
+    """
+    def __init__(self, maxsize=500, coalesce_threshold=3, max_batch=5):
+        self.maxsize = maxsize
+        self.coalesce_threshold = coalesce_threshold
+        self.max_batch = max_batch # most notifications drain() will return at once
+        self.lock = threading.Lock()
+        self.queue = deque()
+        self.limiters = {}
+        self.held = OrderedDict() # subscription -> (number of notifications held back, the oldest coalesce_threshold of them)
+        self.received = 0
+        self.dropped = 0 # notifications discarded because the queue was full
+        self.coalesced = 0 # notifications folded into a summary instead of shown on their own
+
+    @property
+    def depth(self):
+        return len(self.queue)
+
+    def set_rate_limit(self, key, rate, burst=1):
+        """Limit notifications for key (usually a subscription) to rate per minute. A rate of 0 or None removes the limit."""
+        with self.lock:
+            if rate:
+                self.limiters[key] = RateLimiter(rate, burst)
+            else:
+                self.limiters.pop(key, None)
+
+    def clear_rate_limits(self):
+        with self.lock:
+            self.limiters = {}
+
+    def put(self, key, title, message, now=None, priority=0, icon=None):
+        """Queue a notification; called from the network thread. Returns False if the queue was full and it was dropped.
+When more subscriptions have notifications waiting than fit in one batch, those with higher priority ones are shown first. Icon is the digest of the notification's icon in the icon cache (see icons.py), if it has one.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            self.received += 1
+            if len(self.queue) >= self.maxsize:
+                self.dropped += 1
+                return False
+            self.queue.append((key, title, message, now, priority, icon))
+            return True
+
+    def drain(self, now=None):
+        """Remove everything that's queued and return a list of (key, title, message, received, icon) tuples that should actually be shown.
+Received is when the notification was queued; for a summary, it's when the oldest one it covers was queued. A summary has an icon only if every notification in it had the same one.
+No more than max_batch are returned; anything else is held back for the next drain.
+        """
+        if now is None:
+            now = time.time()
+        with self.lock:
+            items = list(self.queue)
+            self.queue.clear()
+            groups = OrderedDict() # subscription -> (count, items), held ones first
+            for key, (count, held) in self.held.items():
+                groups[key] = [count, list(held)]
+            self.held = OrderedDict()
+            for item in items:
+                group = groups.setdefault(item[0], [0, []])
+                group[0] += 1
+                group[1].append(item)
+            out = []
+            # highest priority first; sorting is stable, so otherwise they stay in the order they arrived
+            for key, (count, group) in sorted(groups.items(), key=lambda g: -max([item[4] for item in g[1][1]] or [0])):
+                limiter = self.limiters.get(key, None)
+                if count < self.coalesce_threshold:
+                    # each one shown takes a token; whatever doesn't fit in this batch, or the rate limit, waits for the next
+                    shown = 0
+                    while shown < count and len(out) < self.max_batch and (limiter == None or limiter.take(now)):
+                        item = group[shown]
+                        out.append((item[0], item[1], item[2], item[3], item[5]))
+                        shown += 1
+                    if shown < count:
+                        self.hold(key, count - shown, group[shown:])
+                    continue
+                if len(out) >= self.max_batch or (limiter != None and not limiter.take(now)): # a summary is one notification, and takes one token
+                    self.hold(key, count, group)
+                else:
+                    self.coalesced += count
+                    received = min(item[3] for item in group) if group else None
+                    icons = set(item[5] for item in group)
+                    icon = icons.pop() if len(icons) == 1 and count == len(group) else None
+                    out.append((key, "{} new notifications".format(count), "{} new notifications on {}".format(count, key), received, icon))
+            return out
+
+    def hold(self, key, count, items):
+        """Hold notifications back until the next drain. Only the oldest coalesce_threshold are kept, since any more than that will be summarized anyway."""
+        self.held[key] = (count, items[:max(1, self.coalesce_threshold)])
+
+    def stats(self):
+        """Return a dict of queue statistics."""
+        with self.lock:
+            return {"depth": len(self.queue), "held": sum(count for count, items in self.held.values()), "received": self.received, "dropped": self.dropped, "coalesced": self.coalesced}
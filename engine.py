@@ -0,0 +1,796 @@
+# the mqtt side of mqn, independent of any user interface
+# author: Blake Oliver <oliver22213@me.com>
+
+import getpass
+import hashlib
+import socket
+import threading
+import time
+from socket import gethostname
+from paho.mqtt import client
+import certifi
+import pytoml
+import utils
+from dispatch import DispatchQueue
+from topictrie import TopicTrie
+from reconnect import Broker, ReconnectScheduler
+from dedupe import SeenStore, message_key
+from subscriptions import SubscriptionPipeline, SUBACK_FAILURE
+from decoders import Decoder, DecodeError
+from metrics import Metrics, TextfileExporter, SocketExporter
+from history import NotificationHistory
+from relay import RelayServer, RelayClient
+from rules import compile_rules, SuppressionCache
+from icons import IconCache, is_reference
+from netloop import NetworkLoop, STATE_DISCONNECTED, STATE_WAITING, STATE_CONNECTING, STATE_CONNECTED, STATE_DISCONNECTING
+from constants import default_config, connect_codes
+
+
+# options in the mqn section that the seen message store is built from
+dedupe_options = ('dedupe', 'dedupe_path', 'dedupe_max_entries', 'dedupe_ttl')
+# options in the mqn section that the notification history is opened with
+history_options = ('history', 'history_path', 'history_max_entries')
+# options in the mqn section that metrics exporting is set up from
+metrics_options = ('metrics_file', 'metrics_socket', 'metrics_interval')
+# options in the mqn section that the icon cache is built from
+icon_options = ('icon_cache_size', 'icon_cache_path', 'icon_disk_entries', 'max_icon_size')
+
+# the metrics every engine records, as (name, kind, help); see metrics.py
+metric_definitions = (
+    ("mqn_messages_received_total", "counter", "Messages received, by the subscription they matched."),
+    ("mqn_messages_ignored_total", "counter", "Messages that weren't notifications: rejected by the payload pre-filter, or decoded but missing a notification's fields."),
+    ("mqn_parse_failures_total", "counter", "Messages that passed the payload pre-filter but couldn't be decoded."),
+    ("mqn_duplicates_total", "counter", "Redelivered notifications dropped because they had already been shown."),
+    ("mqn_notifications_total", "counter", "Notifications queued to be shown."),
+    ("mqn_rule_dropped_total", "counter", "Notifications dropped by a topic rule."),
+    ("mqn_suppressed_total", "counter", "Notifications suppressed because one with the same suppression key was shown recently."),
+    ("mqn_quiet_hours_total", "counter", "Notifications recorded but not shown because of a rule's quiet hours."),
+    ("mqn_icons_total", "counter", "Notification icons, by whether they were sent as an image, a reference to one already cached, a reference to one mqn doesn't have, or were invalid."),
+    ("mqn_notification_latency_seconds", "histogram", "Time from a notification being received to it being shown."),
+    ("mqn_request_rtt_seconds", "histogram", "Time the broker took to answer SUBSCRIBE and UNSUBSCRIBE requests."),
+    ("mqn_connects_total", "counter", "Connections established to the broker."),
+    ("mqn_connect_failures_total", "counter", "Connection attempts that failed or were refused."),
+    ("mqn_connections_lost_total", "counter", "Connections that closed without mqn asking them to."),
+    ("mqn_connection_state", "gauge", "1 for the broker connection's current state, 0 for the others."),
+    ("mqn_subscribed_topics", "gauge", "Topics currently subscribed to."),
+    ("mqn_time_to_subscribed_seconds", "gauge", "How long subscribing to every topic took after the last connect."),
+    ("mqn_dispatch_queue_depth", "gauge", "Notifications waiting to be shown."),
+    ("mqn_dispatch_held", "gauge", "Notifications held back by rate limits."),
+    ("mqn_dispatch_dropped_total", "counter", "Notifications dropped because the dispatch queue was full."),
+    ("mqn_dispatch_coalesced_total", "counter", "Notifications folded into summaries instead of shown on their own."),
+    ("mqn_relay_clients", "gauge", "Local clients connected to the relay."),
+    ("mqn_relay_messages_total", "counter", "Messages forwarded to relay clients."),
+    ("mqn_relay_dropped_total", "counter", "Messages discarded because a relay client wasn't keeping up."),
+)
+
+
+class ConfigError(Exception):
+    """Raised when the configuration is missing or unusable. Caption is a short summary, message explains what to do about it."""
+    def __init__(self, caption, message):
+        super(ConfigError, self).__init__(message)
+        self.caption = caption
+        self.message = message
+
+
+class MqnEngine(object):
+    """Handles configuration, the mqtt broker connection, subscriptions and notification routing.
+Accepted notifications are queued, and passed to notify() when dispatch_pending() is called; by default notify() hands them to every sink in self.sinks (see sinks.py). A user interface can subclass this and override notify() and set_status() instead.
+Broker is the name of a [broker."name"] table to connect to instead of the one in [mqtt]; only topics with a matching broker option are subscribed to.
+Several engines can share one NetworkLoop (and so one network thread); if network_loop isn't given, the engine makes its own. They can share a Metrics registry the same way, labelling what they record with their broker's name.
+If relay is the path of a unix socket, other mqn processes on this host can share the engine's broker connection through it (see relay.py), and topics in config become optional.
+    """
+    def __init__(self, sinks=None, broker=None, network_loop=None, metrics=None, relay=None):
+        self.broker_name = broker
+        self.relay_path = relay
+        self.relay = None
+        self.mqtt_connection_is_set_up = False
+        self.mqtt_state = STATE_DISCONNECTED
+        self.mqtt_next_attempt = 0
+        self.mqtt_idle = threading.Event() # set whenever mqtt_state is STATE_DISCONNECTED
+        self.mqtt_idle.set()
+        self.mqtt_refused_code = None
+        self.mqtt_notified_refusal = None # the refusal code last notified about since we were last connected, so retries with the same one don't each show a balloon
+        self.owns_network_loop = network_loop == None
+        if network_loop == None:
+            network_loop = NetworkLoop()
+        self.network_loop = network_loop
+        self.muted = False
+        self.status = ""
+        self.mqtt_message_ids = {}
+        self.mqtt_request_times = {} # message id -> when the request was sent, for timing the broker's answer
+        if metrics == None:
+            metrics = Metrics()
+        self.metrics = metrics
+        self.metrics_broker = broker or "mqtt"
+        for definition in metric_definitions:
+            self.metrics.define(*definition)
+        self.metrics_exporters = []
+        if sinks == None:
+            sinks = []
+        self.sinks = sinks
+        self.setup_config()
+        self.suppression = SuppressionCache(self.config['mqn']['suppress_cache_size'])
+        self.dispatch_queue = DispatchQueue(self.config['mqn']['queue_size'], self.config['mqn']['coalesce_threshold'], self.config['mqn']['max_balloons'])
+        self.setup_rate_limits()
+        self.setup_seen_store()
+        self.setup_history()
+        self.setup_icon_cache()
+        self.subscription_pipeline = SubscriptionPipeline()
+        self.setup_subscription_pipeline()
+        self.setup_metrics_export()
+        self.metrics.add_collector(self.collect_metrics)
+        self.client = self.make_client()
+        self.mqtt_setup_connection()
+        self.setup_relay()
+        if self.config['mqn']['autoconnect'] == True:
+            self.mqtt_connect()
+
+    def setup_config(self):
+        """Load and check the configuration file, and build the subscription list from it. Raises ConfigError if it can't be used."""
+        self.user_config, self.config_file, self.config, self.mqtt_subscriptions, self.topic_trie = self.read_config()
+        if self.config_file != None:
+            self.config_mtime = utils.config_mtime(self.config_file)
+
+    def read_config(self):
+        """Load and check the configuration file, and return (user_config, config_file, config, subscriptions, topic_trie) built from it, without changing anything. Raises ConfigError if it can't be used."""
+        try:
+            user_config, config_file = utils.get_config()
+        except pytoml.TomlError as e:
+            raise ConfigError("Invalid configuration file", "The configuration file couldn't be read:\n{}".format(e))
+        # config checks...
+        if user_config == None:
+            raise ConfigError("No configuration file found", "No configuration could be found for Mqn. Please create one and run this program again.")
+        config = utils.combine_config(user_config, default_config)
+        if config.get('mqtt', None) == None:
+            raise ConfigError("Missing mqtt options", "There is no 'mqtt' section in the configuration file.\nPlease specify one with your desired options and run this program again.")
+        if self.broker_name != None:
+            if config.get('broker', {}).get(self.broker_name, None) == None:
+                raise ConfigError("Unknown broker", "There is no [broker.\"{}\"] section in the configuration file.".format(self.broker_name))
+            # options not given for this broker are taken from the mqtt section
+            mqtt = dict(config['mqtt'])
+            mqtt.update(config['broker'][self.broker_name])
+            config['mqtt'] = mqtt
+        if config['mqtt'].get('host', None) == None and config['mqtt'].get('relay', None) == None:
+            raise ConfigError("No mqtt host specified", "An mqtt host wasn't specified in the configuration file.\nPlease specify one and run this program again.")
+        if config.get('topic', None) == None and config['mqn'].get('base_topic', None) == None and self.relay_path == None:
+            raise ConfigError("No notification topics in config", "No notification topics have been specified in the configuration file, and no base topic was set.\nYou must specify at least one topic for mqn to subscribe to, or a bas _topic.\nPlease do so, and then restart this program.")
+        # all verification checks have passed
+        subscriptions = {}
+        if config['mqn'].get('base_topic', None) != None and self.broker_name == None:
+            subscriptions[config['mqn']['base_topic']] = {"subscribed": False, "decoder": self.make_decoder("base_topic", {}, config), "rules": None}
+            if config['mqn'].get('directed_notifications', False) == True:
+                if config['mqn']['base_topic'].endswith('/'):
+                    m_topic = config['mqn']['base_topic']+gethostname().replace('+', '')
+                else:
+                    m_topic = config['mqn']['base_topic']+'/'+gethostname().replace('+', '')
+                subscriptions[m_topic] = {"subscribed": False, "decoder": self.make_decoder("base_topic", {}, config), "rules": None}
+        if config.get('topic', None) != None:
+            for sub in config['topic'].iterkeys():
+                if config['topic'][sub].get('broker', None) != self.broker_name: # this topic is for a different broker
+                    continue
+                subscriptions[sub] = {"subscribed": False, "qos": config['topic'][sub].get('qos', 0), "rate_limit": config['topic'][sub].get('rate_limit', None), "burst": config['topic'][sub].get('burst', None), "decoder": self.make_decoder(sub, config['topic'][sub], config), "rules": self.make_rules(sub, config['topic'][sub])}
+        if self.broker_name != None and len(subscriptions) == 0 and self.relay_path == None:
+            raise ConfigError("No topics for broker", "No topics have been given for the broker \"{}\".\nSet broker = \"{}\" on the topics that should be subscribed to on it.".format(self.broker_name, self.broker_name))
+        # incoming messages are routed through this rather than registering a paho callback per subscription
+        return user_config, config_file, config, subscriptions, TopicTrie(subscriptions)
+
+    def make_decoder(self, subname, options, config):
+        """Build the payload decoder for a topic from its format and compression options (and the size limits in config). Raises ConfigError if they aren't usable."""
+        try:
+            return Decoder(options.get('format', "json"), options.get('compression', "none"), config['mqn']['max_payload_size'], config['mqn']['max_decompressed_size'])
+        except ValueError as e:
+            raise ConfigError("Invalid topic options", "The options for {} can't be used: {}.".format(subname, e))
+
+    def make_rules(self, subname, options):
+        """Compile a topic's rules (its [[topic."name".rule]] tables), or return None if it has none. Raises ConfigError if any are invalid."""
+        if not options.get('rule', None):
+            return None
+        try:
+            return compile_rules(options['rule'])
+        except ValueError as e:
+            raise ConfigError("Invalid topic rule", "The rules for {} can't be used: {}.".format(subname, e))
+
+    def setup_rate_limits(self, subscriptions=None):
+        """Apply per-subscription rate limits from config to the dispatch queue, falling back to the global ones in the mqn section. Subscriptions defaults to the current ones."""
+        if subscriptions == None:
+            subscriptions = self.mqtt_subscriptions
+        self.dispatch_queue.clear_rate_limits()
+        for subname, sub in subscriptions.iteritems():
+            rate = sub.get('rate_limit', None)
+            if rate == None:
+                rate = self.config['mqn']['rate_limit']
+            burst = sub.get('burst', None)
+            if burst == None:
+                burst = self.config['mqn']['burst']
+            self.dispatch_queue.set_rate_limit(subname, rate, burst)
+
+    def setup_subscription_pipeline(self):
+        """Apply the subscription chunking and retry options from config."""
+        p = self.subscription_pipeline
+        p.chunk_size = max(1, self.config['mqn']['subscribe_chunk_size'])
+        p.window = max(1, self.config['mqn']['subscribe_window'])
+        p.timeout = self.config['mqn']['subscribe_timeout']
+        p.max_retries = self.config['mqn']['subscribe_retries']
+        p.retry_min = self.config['mqtt']['min_reconnect_delay']
+        p.retry_max = self.config['mqtt']['max_reconnect_delay']
+
+    def setup_seen_store(self):
+        """Open the store of already seen messages, used to drop redelivered duplicates, if it's enabled in config."""
+        if getattr(self, 'seen_store', None) != None:
+            self.seen_store.close()
+        self.seen_store = None
+        if self.config['mqn']['dedupe'] == True:
+            path = self.config['mqn']['dedupe_path']
+            if path.lower() == "auto":
+                path = utils.get_data_path("seen.sqlite")
+            self.seen_store = SeenStore(path, self.config['mqn']['dedupe_max_entries'], self.config['mqn']['dedupe_ttl'])
+
+    def setup_history(self):
+        self.history = self.make_history()
+
+    def make_history(self):
+        """Open the notification history, if it's enabled in config; returns None if it isn't."""
+        if self.config['mqn']['history'] != True:
+            return None
+        path = self.config['mqn']['history_path']
+        if path.lower() == "auto":
+            path = utils.get_data_path("history.sqlite")
+        return NotificationHistory(path, self.config['mqn']['history_max_entries'])
+
+    def setup_icon_cache(self):
+        self.icon_cache = self.make_icon_cache()
+
+    def make_icon_cache(self):
+        """Create the cache of notification icons, with a disk tier if icon_cache_path is set. Raises ConfigError if its directory can't be created."""
+        path = self.config['mqn']['icon_cache_path']
+        if path.lower() == "auto":
+            path = utils.get_data_path("icons")
+        try:
+            return IconCache(self.config['mqn']['icon_cache_size'], self.config['mqn']['max_icon_size'], path or None, self.config['mqn']['icon_disk_entries'])
+        except (IOError, OSError) as e:
+            raise ConfigError("Couldn't create the icon cache", "The icon cache directory {} couldn't be created:\n{}".format(path, e))
+
+    def setup_relay(self):
+        """Start sharing this engine's broker connection on the relay socket, if one was given."""
+        if self.relay_path == None:
+            return
+        try:
+            self.relay = RelayServer(self.relay_path, self)
+        except (ValueError, socket.error, OSError) as e:
+            raise ConfigError("Couldn't start the relay", "The relay socket {} couldn't be opened:\n{}".format(self.relay_path, e))
+
+    def setup_metrics_export(self):
+        """Start exporting metrics to a file and/or a unix socket, if config asks for either. Only the main broker's engine exports, since engines for other brokers share its metrics."""
+        for exporter in self.metrics_exporters:
+            exporter.close()
+        self.metrics_exporters = []
+        if self.broker_name != None:
+            return
+        try:
+            if self.config['mqn']['metrics_file'] != "":
+                self.metrics_exporters.append(TextfileExporter(self.metrics, self.config['mqn']['metrics_file'], self.config['mqn']['metrics_interval']))
+            if self.config['mqn']['metrics_socket'] != "":
+                self.metrics_exporters.append(SocketExporter(self.metrics, self.config['mqn']['metrics_socket']))
+        except (ValueError, socket.error, OSError, IOError) as e:
+            raise ConfigError("Couldn't export metrics", "Metrics can't be exported as the configuration file asks:\n{}".format(e))
+
+    def collect_metrics(self, metrics):
+        """Set gauges from the current state of things; called by the metrics registry just before it's read."""
+        b = self.metrics_broker
+        for state in (STATE_DISCONNECTED, STATE_WAITING, STATE_CONNECTING, STATE_CONNECTED, STATE_DISCONNECTING):
+            metrics.set("mqn_connection_state", int(self.mqtt_state == state), broker=b, state=state)
+        metrics.set("mqn_subscribed_topics", len([s for s in self.mqtt_subscriptions.itervalues() if s['subscribed']]), broker=b)
+        stats = self.dispatch_queue.stats()
+        metrics.set("mqn_dispatch_queue_depth", stats['depth'], broker=b)
+        metrics.set("mqn_dispatch_held", stats['held'], broker=b)
+        metrics.set("mqn_dispatch_dropped_total", stats['dropped'], broker=b)
+        metrics.set("mqn_dispatch_coalesced_total", stats['coalesced'], broker=b)
+        if self.relay != None:
+            metrics.set("mqn_relay_clients", len(self.relay.clients), broker=b)
+            metrics.set("mqn_relay_messages_total", self.relay.messages, broker=b)
+            metrics.set("mqn_relay_dropped_total", self.relay.dropped, broker=b)
+
+    def statistics(self):
+        """Return a short summary of this engine's metrics, as a list of lines for a person to read."""
+        m, b = self.metrics, self.metrics_broker
+        m.collect()
+        def ms(h, q):
+            if h == None or h.count == 0:
+                return "n/a"
+            return "{:.0f} ms".format(h.quantile(q) * 1000)
+        latency = m.merged("mqn_notification_latency_seconds", broker=b)
+        rtt = m.merged("mqn_request_rtt_seconds", broker=b, request="subscribe")
+        stats = self.dispatch_queue.stats()
+        lines = [
+            "connection: {} ({})".format(self.mqtt_state, self.reconnect.current()),
+            "messages received: {}, ignored: {}, parse failures: {}".format(m.total("mqn_messages_received_total", broker=b), m.total("mqn_messages_ignored_total", broker=b), m.total("mqn_parse_failures_total", broker=b)),
+            "notifications: {}, duplicates: {}, coalesced: {}, dropped: {}".format(m.total("mqn_notifications_total", broker=b), m.total("mqn_duplicates_total", broker=b), stats['coalesced'], stats['dropped']),
+            "time to show: median {}, 99th percentile {}".format(ms(latency, 0.5), ms(latency, 0.99)),
+            "subscribe round trip: median {}, 99th percentile {}".format(ms(rtt, 0.5), ms(rtt, 0.99)),
+            "connections: {}, failed attempts: {}, lost: {}".format(m.total("mqn_connects_total", broker=b), m.total("mqn_connect_failures_total", broker=b), m.total("mqn_connections_lost_total", broker=b)),
+        ]
+        tts = m.get("mqn_time_to_subscribed_seconds", broker=b)
+        if tts != None:
+            lines.append("subscribed to {} topics in {:.2f} seconds".format(m.total("mqn_subscribed_topics", broker=b), tts))
+        return lines
+
+    def mqtt_client_id(self):
+        """Return the client id to connect with.
+If it's set to "auto" in config, derive one from this machine's name and the current user, so it stays the same between runs (which the broker needs to keep our session) without colliding with other users of the same broker.
+        """
+        client_id = self.config['mqtt']['client_id']
+        if client_id.lower() != "auto":
+            return client_id
+        try:
+            user = getpass.getuser()
+        except (KeyError, ImportError, OSError): # no login name available, like in some containers
+            user = ""
+        # mqtt 3.1 brokers only promise to accept client ids of up to 23 characters
+        return "mqn-"+hashlib.sha1((gethostname()+"/"+user).encode('utf-8')).hexdigest()[:16]
+
+    def make_client(self):
+        """Return a new client for the connection: a paho client for a broker, or a RelayClient if config says to go through a local relay."""
+        if self.config['mqtt'].get('relay', None) != None:
+            return RelayClient()
+        return client.Client(client_id=self.mqtt_client_id(), clean_session=self.config['mqtt']['clean_session'])
+
+    def mqtt_setup_connection(self, force=False, reload=False):
+        """Configures the mqtt broker connection with options set in config (host, port, ssl and specific args, username and pw)."""
+        if self.mqtt_connection_is_set_up == False or force==True:
+            if self.mqtt_loop_running == True:
+                self.mqtt_disconnect()
+            if reload==True:
+                self.client = self.make_client() # a fresh client rather than reinitialise(), since the relay setting may have changed what kind it needs to be
+            if self.config['mqtt'].get('relay', None) != None:
+                # the relay process has the broker's credentials and ssl options; we just need to reach its socket
+                self.reconnect = ReconnectScheduler([Broker(self.config['mqtt']['relay'], None)], self.config['mqtt']['min_reconnect_delay'], self.config['mqtt']['max_reconnect_delay'])
+                self.mqtt_connection_is_set_up = True
+                return
+            if self.config['mqtt'].get('username', None) != None:
+                if self.config['mqtt'].get('password', None) == None: # no password, just a username
+                    self.client.username_pw_set(self.config['mqtt']['username'])
+                else: # username and pw
+                    self.client.username_pw_set(self.config['mqtt']['username'], self.config['mqtt']['password'])
+            if self.config['mqtt']['ssl'] == True: # ssl is enabled for this broker connection
+                tls = {}
+                if self.config['mqtt']['ca_certs'].lower() == "auto":
+                    tls['ca_certs'] = certifi.where()
+                if self.config['mqtt'].get('certfile', None) != None:
+                    tls['certfile'] = self.config['mqtt']['certfile']
+                if self.config['mqtt'].get('keyfile', None) != None:
+                    tls['keyfile'] = self.config['mqtt']['keyfile']
+                self.client.tls_set(**tls)
+            brokers = [Broker(self.config['mqtt']['host'], self.config['mqtt']['port'])]
+            for spec in self.config['mqtt'].get('fallback_hosts', []):
+                brokers.append(Broker.from_spec(spec, self.config['mqtt']['port']))
+            self.reconnect = ReconnectScheduler(brokers, self.config['mqtt']['min_reconnect_delay'], self.config['mqtt']['max_reconnect_delay'])
+            self.mqtt_connection_is_set_up = True
+
+    @property
+    def mqtt_connected(self):
+        return self.mqtt_state == STATE_CONNECTED
+
+    @property
+    def mqtt_loop_running(self):
+        """Whether the network loop is servicing this engine's connection (whether or not it's connected right now)."""
+        return self.mqtt_state != STATE_DISCONNECTED
+
+    def mqtt_connect(self):
+        """Hands the connection to the network loop, which connects to the mqtt broker specified in config (or one of its fallbacks), keeps the connection serviced, and reconnects according to the reconnect scheduler if it's lost."""
+        if self.mqtt_connection_is_set_up == False:
+            self.mqtt_setup_connection()
+        if self.client.on_connect==None or self.client.on_disconnect==None:
+            self.mqtt_set_callbacks()
+        if self.mqtt_loop_running:
+            self.mqtt_disconnect()
+        self.mqtt_idle.clear()
+        self.mqtt_next_attempt = 0
+        self.mqtt_state = STATE_WAITING
+        self.network_loop.add(self)
+
+    def mqtt_attempt_connect(self):
+        """Try to connect to the broker the reconnect scheduler picked. Called by the network loop once mqtt_next_attempt has passed."""
+        broker = self.reconnect.current()
+        self.mqtt_refused_code = None
+        try:
+            self.client.connect(broker.host, broker.port, self.config['mqtt']['keepalive'])
+        except (socket.error, OSError) as e:
+            self.metrics.inc("mqn_connect_failures_total", broker=self.metrics_broker)
+            self.mqtt_retry_later()
+            self.set_status("couldn't connect to {}, retrying in {:.0f} seconds".format(broker, self.mqtt_next_attempt - time.time()))
+            return
+        self.mqtt_state = STATE_CONNECTING
+
+    def mqtt_retry_later(self):
+        self.mqtt_next_attempt = time.time() + self.reconnect.failed(self.mqtt_refused_code)
+        self.mqtt_state = STATE_WAITING
+
+    def mqtt_connection_closed(self):
+        """Called by the network loop when the connection's socket has closed, either because we asked it to or because it was lost or refused."""
+        self.mqtt_forget_subscriptions()
+        if self.mqtt_state == STATE_DISCONNECTING:
+            self.network_loop.discard(self)
+            self.mqtt_state = STATE_DISCONNECTED
+            self.mqtt_idle.set()
+            return
+        broker = self.reconnect.current()
+        if self.mqtt_state == STATE_CONNECTED:
+            self.metrics.inc("mqn_connections_lost_total", broker=self.metrics_broker)
+        refused = self.mqtt_refused_code
+        self.mqtt_retry_later()
+        if refused != None:
+            self.set_status("{}: {}, retrying {} in {:.0f} seconds".format(broker, connect_codes.get(refused, "connection refused (reason unknown)"), self.reconnect.current(), self.mqtt_next_attempt - time.time()))
+        else:
+            self.set_status("disconnected from {}, reconnecting to {} in {:.0f} seconds".format(broker, self.reconnect.current(), self.mqtt_next_attempt - time.time()))
+
+    def mqtt_forget_subscriptions(self):
+        """Mark every topic unsubscribed and drop any requests still waiting on the broker, since the connection they belonged to is gone."""
+        self.subscription_pipeline.reset()
+        self.mqtt_message_ids = {}
+        self.mqtt_request_times = {}
+        for sub in self.mqtt_subscriptions.itervalues():
+            sub['subscribed'] = False
+        if self.relay != None:
+            self.relay.connection_lost()
+
+    def mqtt_service(self, now):
+        """Called by the network loop on every pass while connected. Sends subscription retries that have come due, and returns how many seconds until it needs calling again (or None if it doesn't)."""
+        due = self.subscription_pipeline.next_due()
+        if due != None and due <= now:
+            self.mqtt_pump_subscriptions(now)
+            due = self.subscription_pipeline.next_due()
+        if due == None:
+            return None
+        return max(0, due - now)
+
+    def mqtt_set_callbacks(self):
+        guard = self.network_loop.guard # so a bug handling one message can't take down the network loop (and every other broker's connection)
+        self.client.on_connect = guard(self, self.on_connect)
+        self.client.on_disconnect = guard(self, self.on_disconnect)
+        self.client.on_subscribe = guard(self, self.on_subscribe)
+        self.client.on_unsubscribe = guard(self, self.on_unsubscribe)
+        self.client.on_message = guard(self, self.on_notification, drop=True)
+
+    def mqtt_disconnect(self):
+        """Disconnect from the mqtt broker if we're connected, and stop the network loop servicing this connection."""
+        if self.mqtt_state == STATE_DISCONNECTED:
+            return
+        self.network_loop.call(self._mqtt_begin_disconnect)
+        if not self.network_loop.on_loop_thread():
+            self.mqtt_idle.wait(5) # long enough to send DISCONNECT to a responsive broker
+
+    def _mqtt_begin_disconnect(self):
+        if self.client.socket() == None: # nothing to close
+            self.mqtt_forget_subscriptions()
+            self.network_loop.discard(self)
+            self.mqtt_state = STATE_DISCONNECTED
+            self.mqtt_idle.set()
+        else: # the network loop finishes up in mqtt_connection_closed, once DISCONNECT has been sent
+            self.mqtt_state = STATE_DISCONNECTING
+            self.client.disconnect()
+
+    def on_connect(self, c, u, f, r):
+        if r > 0:
+            # the network thread will back off and try again (maybe on a different broker) once paho notices the connection is closed
+            self.metrics.inc("mqn_connect_failures_total", broker=self.metrics_broker)
+            self.mqtt_refused_code = r
+            self.client.disconnect()
+            self.set_status(connect_codes.get(r, "connection refused (reason unknown)"))
+            # only the first refusal (or one for a different reason) gets a notification; retries after that just update the status
+            if self.muted == False and r != self.mqtt_notified_refusal:
+                self.mqtt_notified_refusal = r
+                if r in connect_codes:
+                    self.notify("Connection failed to {}".format(self.reconnect.current().host), connect_codes[r])
+                else:
+                    self.notify("Connection refused", "The connection to {} was refused (reason unknown)".format(self.reconnect.current().host))
+            return
+        self.set_status(connect_codes[r])
+        self.mqtt_notified_refusal = None
+        if r == 0:
+            self.mqtt_state = STATE_CONNECTED
+            self.metrics.inc("mqn_connects_total", broker=self.metrics_broker)
+            self.reconnect.connected()
+            # build a list of tuples of the form (subscription, qos)
+            # this helps consolidate what could be many subscriptions into just one request, rather than firing off each sub individually
+            subtuples = []
+            for subname, sub in self.mqtt_subscriptions.iteritems():
+                subtuples.append((subname, sub.get('qos', 0)))
+            if self.relay != None: # and whatever the relay's clients want
+                subtuples.extend(self.relay.subscriptions())
+            # these get sent in chunks, with a limited number of requests outstanding at once; see SubscriptionPipeline
+            self.subscription_pipeline.start(subtuples)
+            self.mqtt_pump_subscriptions()
+            if self.config['mqn']['quiet'] == False and self.muted == False:
+                self.notify("Connected to mqtt broker", "Connection established to {}".format(self.reconnect.current().host))
+
+    def on_disconnect(self, c, u, r):
+        if self.mqtt_refused_code != None: # never really connected; on_connect has already said why
+            return
+        if r > 0:
+            self.set_status("disconnected unexpectedly, reconnecting soon")
+            if self.config['mqn']['quiet'] == False and self.muted == False:
+                self.notify("Unexpectedly disconnected from {}".format(self.reconnect.current().host), "Connection to the mqtt broker has been lost; trying to reconnect soon.")
+        else:
+            self.set_status("disconnected")
+            if self.config['mqn']['quiet'] == False and self.muted==False:
+                self.notify("Disconnected from mqtt broker", "disconnected from {}".format(self.reconnect.current().host))
+
+    def on_subscribe(self, c, u, mid, granted_qos):
+        """Callback that gets called when the broker answers a subscription request. Updates a dict so other code can check the subscribed status of topics, and queues any the broker refused to be retried."""
+        subs = self.mqtt_message_ids.pop(mid, []) # acknowledged, no need to waist space
+        self.observe_request_rtt(mid, "subscribe")
+        self.subscription_pipeline.acknowledged(mid, granted_qos)
+        refused = []
+        for sub, granted in zip(subs, granted_qos):
+            if self.relay != None:
+                self.relay.acknowledged(sub, granted)
+            if sub not in self.mqtt_subscriptions: # removed from config while the request was in flight, or only subscribed to for the relay
+                continue
+            if granted == SUBACK_FAILURE:
+                refused.append(sub)
+                continue
+            self.mqtt_subscriptions[sub]['subscribed']= True
+            self.topic_trie.add(sub, self.mqtt_subscriptions[sub])
+        if refused:
+            self.set_status("the broker refused {}".format(", ".join(refused)))
+        self.mqtt_pump_subscriptions()
+
+    def on_unsubscribe(self, c, u, mid):
+        """Callback that gets called when an unsubscribe request is granted by the broker. Updates a dict so other code can check the subscribed status of topics."""
+        subs = self.mqtt_message_ids[mid]
+        self.observe_request_rtt(mid, "unsubscribe")
+        for sub in subs:
+            if sub in self.mqtt_subscriptions:
+                self.mqtt_subscriptions[sub]['subscribed'] = False
+            self.topic_trie.remove(sub) # stop routing anything still in flight for this topic
+        del(self.mqtt_message_ids[mid])
+
+    def observe_request_rtt(self, mid, request):
+        sent = self.mqtt_request_times.pop(mid, None)
+        if sent != None:
+            self.metrics.observe("mqn_request_rtt_seconds", time.time() - sent, broker=self.metrics_broker, request=request)
+
+    def on_notification(self, c, u, msg):
+        """Called on the mqtt network thread for every incoming message; valid notifications are only queued here, and handed to notify() later by dispatch_pending()."""
+        if self.relay != None:
+            self.relay.publish(msg)
+        matches = self.topic_trie.match(msg.topic)
+        if not matches: # not on any topic we're (still) subscribed to
+            return
+        subname, sub = matches[0] # the most specific subscription's options apply
+        self.metrics.inc("mqn_messages_received_total", broker=self.metrics_broker, topic=subname)
+        try:
+            m = sub['decoder'].decode(msg.payload) # cheap checks first, so most non-notifications are never parsed
+        except DecodeError as e:
+            self.metrics.inc("mqn_parse_failures_total", broker=self.metrics_broker, topic=subname)
+            return # not a valid mqn message
+        if m == None or not (m.get('type', None) == 'notification' and m.get('title', False) and m.get('message', False)):
+            self.metrics.inc("mqn_messages_ignored_total", broker=self.metrics_broker, topic=subname)
+            return
+        rule = sub['rules'].evaluate(m) if sub.get('rules', None) != None else None
+        if rule != None and rule.action == "drop":
+            self.metrics.inc("mqn_rule_dropped_total", broker=self.metrics_broker, topic=subname)
+            return
+        if self.is_duplicate(msg):
+            self.metrics.inc("mqn_duplicates_total", broker=self.metrics_broker, topic=subname)
+            return
+        now = time.time()
+        title, message = utils.as_text(m['title']), utils.as_text(m['message']) # publishers can send any json type here
+        if rule != None:
+            key = rule.key(m)
+            if key != None and self.suppression.seen((subname, key), rule.suppress_ttl, now): # only touched on the network thread
+                self.metrics.inc("mqn_suppressed_total", broker=self.metrics_broker, topic=subname)
+                return
+        icon = self.resolve_icon(m, subname) # even if it won't be shown, so later references to it work
+        if self.history != None: # recorded even when muted or in quiet hours, so nothing missed is lost
+            self.history.add(subname, msg.topic, title, message, now)
+        if rule != None and rule.quiet(now):
+            self.metrics.inc("mqn_quiet_hours_total", broker=self.metrics_broker, topic=subname)
+            return
+        if self.muted == False:
+            self.metrics.inc("mqn_notifications_total", broker=self.metrics_broker, topic=subname)
+            self.dispatch_queue.put(subname, title, message, now, rule.priority if rule != None else 0, icon)
+
+    def resolve_icon(self, m, subname):
+        """Return the icon cache digest of notification m's icon, or None if it doesn't have one (or has one that can't be used, which doesn't stop it being shown)."""
+        if m.get('icon', None) == None:
+            return None
+        try:
+            digest = self.icon_cache.resolve(m['icon'])
+        except ValueError:
+            self.metrics.inc("mqn_icons_total", broker=self.metrics_broker, topic=subname, result="invalid")
+            return None
+        if digest == None:
+            result = "missing"
+        else:
+            result = "reference" if is_reference(m['icon']) else "image"
+        self.metrics.inc("mqn_icons_total", broker=self.metrics_broker, topic=subname, result=result)
+        return digest
+
+    def is_duplicate(self, msg):
+        """Check msg against the seen message store, recording it if it's new.
+Only messages the broker may send again are tracked: qos 1 and 2 messages (which are redelivered, flagged dup, if our acknowledgement was lost), and retained ones (which are sent again every time we subscribe). Anything else with the same content is a genuine repeat, and is let through.
+        """
+        if self.seen_store == None or (msg.qos == 0 and not msg.retain):
+            return False
+        key = message_key(msg.topic, msg.payload)
+        if (msg.dup or msg.retain) and self.seen_store.seen(key):
+            return True
+        self.seen_store.add(key)
+        return False
+
+    def dispatch_pending(self):
+        """Pass whatever notifications have been queued since the last call to notify(). Should be called periodically from the thread that shows notifications."""
+        for key, title, message, received, icon in self.dispatch_queue.drain():
+            if self.muted == False:
+                self.notify(title, message, key, icon)
+                if received != None:
+                    self.metrics.observe("mqn_notification_latency_seconds", time.time() - received, broker=self.metrics_broker)
+        for exporter in self.metrics_exporters:
+            exporter.maybe_write()
+
+    def notify(self, title, message, topic=None, icon=None):
+        """Show a notification. Topic is the subscription it arrived on, or None for mqn's own notifications (connection status and the like).
+Icon is the digest of the notification's icon in self.icon_cache, or None; sinks only show text, so they don't get it.
+        """
+        for sink in self.sinks:
+            sink.notify(title, message, topic)
+
+    def set_status(self, status=""):
+        """Record a short connection status message, and pass it on to any sinks that care."""
+        self.status = status
+        for sink in self.sinks:
+            sink.status(status)
+
+    def mqtt_subscribe(self, subtuples):
+        """Subscribe to a list of (topic, qos) tuples, through the subscription pipeline.
+This happens on the network loop's thread, so each request's message ID is recorded before the broker's answer can be handled."""
+        self.network_loop.call(self._mqtt_subscribe, subtuples)
+
+    def _mqtt_subscribe(self, subtuples):
+        self.subscription_pipeline.add(subtuples)
+        self.mqtt_pump_subscriptions()
+
+    def mqtt_pump_subscriptions(self, now=None):
+        """Send whatever SUBSCRIBE requests the subscription pipeline has room for. Runs on the network loop's thread."""
+        if not self.mqtt_connected:
+            return # everything is subscribed again on connect
+        pipeline = self.subscription_pipeline
+        chunks = pipeline.next_chunks(now)
+        for mid in pipeline.timed_out: # their topics are queued to be retried; a late answer to these is ignored
+            self.mqtt_message_ids.pop(mid, None)
+            self.mqtt_request_times.pop(mid, None)
+        pipeline.timed_out = []
+        for chunk in chunks:
+            r, mid = self.client.subscribe(chunk)
+            pipeline.sent(mid, chunk)
+            self.mqtt_request_times[mid] = time.time()
+            # save the message ID we got for this request, so later on we can mark the specific topic(s) as subscribed or not.
+            self.mqtt_message_ids[mid] = [st[0] for st in chunk] # build a list of just the subscriptions, not their qos values
+        if pipeline.given_up:
+            given_up, pipeline.given_up = pipeline.given_up, []
+            if self.muted == False:
+                self.notify("Couldn't subscribe", "The broker refused subscriptions to {}, and mqn has stopped retrying them.".format(", ".join(given_up)))
+        if pipeline.time_to_subscribed != None and pipeline.started != None:
+            self.metrics.set("mqn_time_to_subscribed_seconds", pipeline.time_to_subscribed, broker=self.metrics_broker)
+            self.set_status("subscribed to {} topics in {:.2f} seconds".format(len([s for s in self.mqtt_subscriptions.itervalues() if s['subscribed']]), pipeline.time_to_subscribed))
+            pipeline.started = None # only report this once per connection
+
+    def mqtt_unsubscribe(self, topics):
+        """Send one UNSUBSCRIBE request for a list of topics, from the network loop's thread like mqtt_subscribe."""
+        self.network_loop.call(self._mqtt_unsubscribe, topics)
+
+    def _mqtt_unsubscribe(self, topics):
+        r, mid = self.client.unsubscribe(topics)
+        self.mqtt_message_ids[mid] = list(topics)
+        self.mqtt_request_times[mid] = time.time()
+
+    def toggle_subscription(self, sub):
+        """Unsubscribe from sub if we're subscribed to it, otherwise subscribe."""
+        if self.mqtt_subscriptions[sub]['subscribed'] == True:
+            self.mqtt_unsubscribe([sub])
+        elif self.mqtt_subscriptions[sub]['subscribed'] == False:
+            self.mqtt_subscribe([(sub, self.mqtt_subscriptions[sub].get('qos', 0))])
+
+    def config_changed(self):
+        """Return True if the configuration file has been modified since it was last loaded."""
+        return self.config_file != None and utils.config_mtime(self.config_file) != self.config_mtime
+
+    def check_config(self):
+        """Reload the configuration if the file has changed; called periodically when watch_config is on. Returns True if it was reloaded.
+Raises ConfigError if the changed file can't be used, in which case the current configuration is kept (and the file isn't looked at again until it changes).
+        """
+        if not self.config_changed():
+            return False
+        self.config_mtime = utils.config_mtime(self.config_file)
+        self.reload_config()
+        return True
+
+    def reload_config(self):
+        """Re-read the configuration file and apply whatever changed.
+Changes to the broker connection (host, credentials, ssl and so on) mean reconnecting; if only topics changed, the differences are sent as SUBSCRIBE and UNSUBSCRIBE requests on the existing connection.
+The new subscriptions are only swapped in on the network loop's thread (in _apply_config_changes), since that's where they're used and updated while connected.
+Returns True if the connection was reestablished. Raises ConfigError if the new configuration can't be used, keeping the current one.
+        """
+        user_config, config_file, config, subscriptions, topic_trie = self.read_config()
+        old_config = self.config
+        self.user_config, self.config_file, self.config = user_config, config_file, config
+        if self.config_file != None:
+            self.config_mtime = utils.config_mtime(self.config_file)
+        self.dispatch_queue.maxsize = self.config['mqn']['queue_size']
+        self.dispatch_queue.coalesce_threshold = self.config['mqn']['coalesce_threshold']
+        self.dispatch_queue.max_batch = self.config['mqn']['max_balloons']
+        self.suppression.max_entries = max(1, self.config['mqn']['suppress_cache_size'])
+        self.setup_rate_limits(subscriptions)
+        self.setup_subscription_pipeline()
+        if [old_config['mqn'][k] for k in metrics_options] != [self.config['mqn'][k] for k in metrics_options]:
+            self.setup_metrics_export()
+        # the history and icon cache are used on the network loop's thread, so new ones are opened here (where errors can be reported) but swapped in there
+        replacements = {}
+        if [old_config['mqn'][k] for k in history_options] != [self.config['mqn'][k] for k in history_options]:
+            replacements['history'] = self.make_history()
+        if [old_config['mqn'][k] for k in icon_options] != [self.config['mqn'][k] for k in icon_options]:
+            try:
+                replacements['icon_cache'] = self.make_icon_cache()
+            except ConfigError:
+                if replacements.get('history', None) != None:
+                    replacements['history'].close()
+                raise
+        if self.config['mqtt'] != old_config['mqtt'] or not self.mqtt_loop_running:
+            # disconnect if necessary, stop the mqtt event loop, reset settings from config, and reconnect again
+            self.mqtt_disconnect()
+            self.mqtt_message_ids = {}
+            # queued before mqtt_connect hands the engine back to the loop, so it connects with the new subscriptions
+            self.network_loop.call(self._apply_config_changes, old_config, subscriptions, topic_trie, replacements)
+            self.mqtt_setup_connection(force=True, reload=True)
+            if self.config['mqn']['autoconnect'] == True:
+                self.mqtt_connect()
+            return True
+        # the connection can stay; work out what to change on it from the network loop's thread, where subscription state is otherwise updated
+        self.network_loop.call(self._apply_config_changes, old_config, subscriptions, topic_trie, replacements)
+        return False
+
+    def _apply_config_changes(self, old_config, subscriptions, topic_trie, replacements):
+        """Swap in the subscriptions from a reloaded config, carrying over what's already subscribed, and subscribe and unsubscribe the differences if we're connected. Replacements maps attributes (history, icon_cache) to new objects to swap in, closing the old ones. Runs on the network loop's thread."""
+        for name, new in replacements.items():
+            old = getattr(self, name)
+            setattr(self, name, new)
+            if old != None:
+                old.close()
+        if [old_config['mqn'][k] for k in dedupe_options] != [self.config['mqn'][k] for k in dedupe_options] or self.config['mqtt'] != old_config['mqtt']:
+            self.setup_seen_store()
+        old_subscriptions = self.mqtt_subscriptions
+        self.mqtt_subscriptions, self.topic_trie = subscriptions, topic_trie
+        subscribe = []
+        for subname, sub in self.mqtt_subscriptions.iteritems():
+            old = old_subscriptions.get(subname, None)
+            if old == None or old.get('qos', 0) != sub.get('qos', 0): # new, or needs resubscribing with a different qos
+                subscribe.append((subname, sub.get('qos', 0)))
+            else:
+                sub['subscribed'] = old['subscribed']
+                if old['subscribed'] == False and self.mqtt_connected: # toggled off from the menu; keep it that way
+                    self.topic_trie.remove(subname)
+        removed = [subname for subname in old_subscriptions if subname not in self.mqtt_subscriptions]
+        pending = self.subscription_pipeline.discard(removed) # still in flight, so they may yet be granted; unsubscribing after them undoes that
+        unsubscribe = [subname for subname in removed if (old_subscriptions[subname]['subscribed'] == True or subname in pending) and not (self.relay != None and self.relay.wants(subname))]
+        if self.mqtt_connected:
+            self._mqtt_subscribe(subscribe) # even with nothing new, so finishing by discarding topics is noticed
+            if unsubscribe:
+                self._mqtt_unsubscribe(unsubscribe)
+
+    def shutdown(self):
+        """Disconnect from the broker, and stop the network loop if it's this engine's own."""
+        self.mqtt_disconnect()
+        if self.relay != None:
+            self.relay.close()
+        if self.owns_network_loop:
+            self.network_loop.stop()
+        if self.seen_store != None:
+            self.seen_store.close()
+        if self.history != None:
+            self.history.close()
+        self.icon_cache.close()
+        for exporter in self.metrics_exporters:
+            exporter.close()
+        self.metrics_exporters = []
+        self.metrics.remove_collector(self.collect_metrics)
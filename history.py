@@ -0,0 +1,156 @@
+# a searchable, bounded history of notifications
+
+import sqlite3
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+
+def fts_query(text):
+    """Turn free text into a full text search query matching every word in it, so punctuation in what the user typed can't be taken as query syntax."""
+    return " ".join('"{}"'.format(word.replace('"', '""')) for word in text.split())
+
+
+class NotificationHistory(object):
+    """Keeps every notification mqn accepts in a sqlite database, so ones whose balloon was missed can be found again.
+The table is a ring: once it holds more than max_entries rows, the oldest are deleted (in batches of a tenth of max_entries, so the cost is spread out). Titles and messages are indexed for full text search with fts5 or fts4, whichever sqlite has; without either, text searches fall back to a slower substring match.
+add() only queues a notification; a writer thread inserts what's queued in one transaction every flush_interval seconds (or as soon as batch_size are waiting), so the network thread never waits on the disk.
+    """
+    def __init__(self, path, max_entries=100000, flush_interval=1.0, batch_size=500):
+        self.max_entries = max(1, max_entries)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.lock = threading.Lock() # guards the database connection
+        self.pending = deque()
+        self.wake = threading.Event()
+        self.closed = False
+        self.db = sqlite3.connect(path, check_same_thread=False) # written from the writer thread, read from the UI thread
+        self.db.execute("pragma journal_mode=wal")
+        self.db.execute("pragma synchronous=normal")
+        self.db.execute("create table if not exists history (id integer primary key, time real not null, subscription text, topic text, title text, message text)")
+        self.db.execute("create index if not exists history_time on history (time)")
+        self.db.execute("create index if not exists history_subscription on history (subscription, time)")
+        self.db.execute("create index if not exists history_topic on history (topic, time)")
+        self.fts = None
+        for module in ("fts5", "fts4"):
+            try:
+                self.db.execute("create virtual table if not exists history_text using {}(title, message)".format(module))
+                self.fts = module
+                break
+            except sqlite3.OperationalError: # not compiled into this sqlite
+                continue
+        self.db.commit()
+        self.prune_slack = max(1, self.max_entries // 10)
+        self.last_id = self.db.execute("select max(id) from history").fetchone()[0] or 0
+        self.first_id = self.db.execute("select min(id) from history").fetchone()[0] or 1
+        self.thread = threading.Thread(target=self.run, name="mqn history")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def add(self, subscription, topic, title, message, now=None):
+        """Queue a notification to be recorded. Safe to call from any thread; never touches the database itself."""
+        if now is None:
+            now = time.time()
+        self.pending.append((now, subscription, topic, title, message))
+        if len(self.pending) >= self.batch_size:
+            self.wake.set()
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait(self.flush_interval)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception: # a batch that can't be written is lost, but the writer carries on with the next one
+                sys.stderr.write("mqn: couldn't write to the notification history:\n")
+                traceback.print_exc()
+
+    def flush(self):
+        """Write everything that's queued, in one transaction."""
+        rows = []
+        while self.pending:
+            rows.append(self.pending.popleft())
+        if not rows:
+            return
+        with self.lock:
+            if self.db == None: # already closed
+                return
+            rows = [(self.last_id + i + 1,) + row for i, row in enumerate(rows)]
+            try:
+                self.db.executemany("insert into history (id, time, subscription, topic, title, message) values (?, ?, ?, ?, ?, ?)", rows)
+                if self.fts != None:
+                    self.db.executemany("insert into history_text (rowid, title, message) values (?, ?, ?)", [(r[0], r[4], r[5]) for r in rows])
+            except Exception:
+                self.db.rollback() # so the next batch starts from a clean transaction, with the same ids
+                raise
+            self.last_id += len(rows)
+            if self.last_id - self.first_id + 1 > self.max_entries + self.prune_slack:
+                self._prune()
+            self.db.commit()
+
+    def _prune(self):
+        oldest_kept = self.last_id - self.max_entries + 1
+        if self.fts != None: # looked up one row at a time, since fts tables can't use a range of rowids efficiently
+            self.db.execute("delete from history_text where rowid in (select id from history where id < ?)", (oldest_kept,))
+        self.db.execute("delete from history where id < ?", (oldest_kept,))
+        self.first_id = oldest_kept
+
+    def query(self, subscription=None, topic=None, since=None, until=None, text=None, limit=50):
+        """Return up to limit notifications matching every criteria given, newest first, as dicts.
+Subscription is the subscription (topic filter) they arrived on and topic is the exact topic they were published to; since and until are timestamps; text must appear in the title or message (as whole words, if there's a full text index).
+        """
+        self.flush()
+        where, args = [], []
+        if subscription != None:
+            where.append("history.subscription = ?")
+            args.append(subscription)
+        if topic != None:
+            where.append("history.topic = ?")
+            args.append(topic)
+        if since != None:
+            where.append("history.time >= ?")
+            args.append(since)
+        if until != None:
+            where.append("history.time < ?")
+            args.append(until)
+        sql = "select history.id, time, subscription, topic, history.title, history.message from history"
+        order = "history.time desc" # walks the time (or subscription or topic) index backwards, rather than sorting
+        if text != None and text.strip() != "":
+            if self.fts != None:
+                # drive the query from the text index, newest match first; ids only go up, so this is newest first too
+                sql = sql.replace("from history", "from history_text join history on history.id = history_text.rowid")
+                where.append("history_text match ?")
+                args.append(fts_query(text))
+                order = "history_text.rowid desc"
+            else:
+                where.append("(instr(history.title, ?) > 0 or instr(history.message, ?) > 0)")
+                args.extend([text, text])
+        if where:
+            sql += " where " + " and ".join(where)
+        sql += " order by {} limit ?".format(order)
+        args.append(limit)
+        with self.lock:
+            rows = self.db.execute(sql, args).fetchall()
+        return [{"id": r[0], "time": r[1], "subscription": r[2], "topic": r[3], "title": r[4], "message": r[5]} for r in rows]
+
+    def recent(self, limit=10):
+        """Return the limit most recent notifications, newest first."""
+        return self.query(limit=limit)
+
+    def count(self):
+        self.flush()
+        with self.lock:
+            return self.db.execute("select count(*) from history").fetchone()[0]
+
+    def close(self):
+        """Write anything still queued, stop the writer thread and close the database."""
+        self.closed = True
+        self.wake.set()
+        if self.thread.is_alive() and threading.current_thread() != self.thread:
+            self.thread.join()
+        self.flush()
+        with self.lock:
+            self.db.close()
+            self.db = None
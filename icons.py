@@ -0,0 +1,162 @@
+# notification icons, stored by the hash of their content
+
+import base64
+import binascii
+import hashlib
+import os
+import re
+import threading
+from collections import deque, OrderedDict
+
+# a reference to an icon sent earlier, rather than the image itself
+reference_pattern = re.compile(r'^sha256:([0-9a-f]{64})$')
+
+
+def is_reference(field):
+    """Return True if an icon field is a reference (like "sha256:<hex digest>") rather than an image."""
+    return isinstance(field, (str, type(u""))) and reference_pattern.match(field) != None
+
+
+class LRUCache(object):
+    """A mapping that holds at most max_entries items, forgetting the least recently used first. Not thread-safe by itself."""
+    def __init__(self, max_entries=100):
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def get(self, key, default=None):
+        if key not in self.entries:
+            return default
+        value = self.entries.pop(key)
+        self.entries[key] = value # now the most recently used
+        return value
+
+    def put(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = value
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+
+class IconCache(object):
+    """Holds the images sent in notifications' icon fields, keyed by the sha256 of their content, so publishers can send "sha256:<hex digest>" instead of an image mqn already has.
+Images are kept in memory (the max_entries most recently used), and, if disk_path is given, as files in that directory too (the disk_max_entries newest), so references still work after mqn restarts.
+resolve() runs on the network thread for every notification with an icon, so it never touches the disk, and a field it has seen before is matched to its digest without being decoded or hashed again. Files are written and deleted by a writer thread, and only read by get(), which the UI thread calls. Everything else is done under a lock.
+    """
+    def __init__(self, max_entries=100, max_size=65536, disk_path=None, disk_max_entries=1000):
+        self.memory = LRUCache(max_entries) # digest -> image data
+        self.fields = LRUCache(max_entries) # icon field -> digest, for fields seen before
+        self.max_size = max_size # largest image accepted, in bytes
+        self.disk_path = disk_path
+        self.disk_max_entries = max(1, disk_max_entries)
+        self.lock = threading.Lock()
+        self.on_disk = OrderedDict() # digests with a file (or one queued to be written), oldest first
+        self.disk_queue = deque() # (digest, data to write, or None to delete it)
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = None
+        if disk_path == None:
+            return
+        if not os.path.isdir(disk_path):
+            os.makedirs(disk_path)
+        for name in sorted(self.disk_files(), key=lambda name: os.path.getmtime(os.path.join(disk_path, name))):
+            self.on_disk[name] = True
+        self.thread = threading.Thread(target=self.run, name="mqn icons")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def resolve(self, field):
+        """Return the digest of the icon a notification's icon field refers to, storing it first if the field holds an image. Returns None if it's a reference to an icon we don't have; raises ValueError if it isn't a valid icon field."""
+        if not isinstance(field, (str, type(u""))):
+            raise ValueError("icon must be a string")
+        m = reference_pattern.match(field)
+        with self.lock:
+            digest = m.group(1) if m != None else self.fields.get(field, None)
+            if digest != None and self.memory.get(digest, None) != None: # also marks it recently used
+                return digest
+            if m != None:
+                return digest if digest in self.on_disk else None
+        encoded = field.partition(",")[2] if field.startswith("data:") else field # a data uri, like data:image/png;base64,...
+        if len(encoded) * 3 // 4 > self.max_size: # checked before decoding anything
+            raise ValueError("icon is larger than {} bytes".format(self.max_size))
+        try:
+            data = base64.b64decode(encoded)
+        except (TypeError, ValueError, binascii.Error): # python 2 raises TypeError for bad base64
+            raise ValueError("icon isn't valid base64")
+        if not data:
+            raise ValueError("icon is empty")
+        digest = self.add(data)
+        with self.lock:
+            self.fields.put(field, digest)
+        return digest
+
+    def add(self, data):
+        """Store image data, returning its digest."""
+        digest = hashlib.sha256(data).hexdigest()
+        with self.lock:
+            if digest in self.memory:
+                self.memory.get(digest) # just mark it recently used
+                return digest
+            self.memory.put(digest, data)
+            if self.disk_path != None and digest not in self.on_disk:
+                self.on_disk[digest] = True
+                self.disk_queue.append((digest, data))
+                while len(self.on_disk) > self.disk_max_entries:
+                    self.disk_queue.append((self.on_disk.popitem(last=False)[0], None))
+                self.wake.set()
+        return digest
+
+    def get(self, digest):
+        """Return the image data for digest, or None if we don't have it. May read it from disk, so shouldn't be called on the network thread."""
+        with self.lock:
+            data = self.memory.get(digest, None)
+            if data != None or digest not in self.on_disk:
+                return data
+        try:
+            with open(os.path.join(self.disk_path, digest), 'rb') as f:
+                data = f.read()
+        except (IOError, OSError):
+            return None
+        if hashlib.sha256(data).hexdigest() != digest: # damaged; don't trust it
+            return None
+        with self.lock:
+            self.memory.put(digest, data)
+        return data
+
+    def disk_files(self):
+        return [name for name in os.listdir(self.disk_path) if re.match(r'^[0-9a-f]{64}$', name)]
+
+    def run(self):
+        while not self.closed:
+            self.wake.wait()
+            self.wake.clear()
+            self.flush()
+
+    def flush(self):
+        """Write and delete whatever files are queued."""
+        while self.disk_queue:
+            digest, data = self.disk_queue.popleft()
+            path = os.path.join(self.disk_path, digest)
+            try:
+                if data == None:
+                    os.remove(path)
+                elif not os.path.exists(path):
+                    with open(path + ".tmp", 'wb') as f:
+                        f.write(data)
+                    os.rename(path + ".tmp", path)
+            except (IOError, OSError): # the disk tier is only an optimization
+                continue
+
+    def close(self):
+        """Write anything still queued and stop the writer thread."""
+        self.closed = True
+        self.wake.set()
+        if self.thread != None and self.thread.is_alive() and threading.current_thread() != self.thread:
+            self.thread.join()
+        if self.disk_path != None:
+            self.flush()
@@ -0,0 +1,225 @@
+# counters and histograms describing what mqn is doing, and ways to export them
+
+import io
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from netloop import remove_stale_socket
+
+# upper bounds (in seconds) of the buckets latency histograms count into
+default_buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+class Histogram(object):
+    """Counts observations into cumulative buckets, the way prometheus histograms do."""
+    def __init__(self, buckets=default_buckets):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1) # the last one is +Inf
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Estimate the q quantile (0 to 1) by interpolating within the bucket it falls in; None if nothing has been observed."""
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            if n and seen + n >= rank:
+                if i == len(self.buckets): # past the last bucket; the best we can say is its bound
+                    return self.buckets[-1]
+                lower = self.buckets[i-1] if i > 0 else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / n
+            seen += n
+        return self.buckets[-1]
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return u"{" + u",".join(u'{}="{}"'.format(k, u"{}".format(v).replace(u'\\', u'\\\\').replace(u'"', u'\\"').replace(u'\n', u'\\n')) for k, v in labels) + u"}"
+
+def format_value(value):
+    if value == float('inf'):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """A thread-safe registry of counters, gauges and histograms, each optionally split by labels.
+Metrics are declared up front with define(), then updated with inc(), set() and observe(), which take labels as keyword arguments. Collectors (functions registered with add_collector) run just before the metrics are read, to set gauges for things that are cheaper to look at than to track, like queue depths.
+    """
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.definitions = {} # name -> (kind, help)
+        self.values = {} # name -> {sorted label tuple -> number or Histogram}
+        self.collectors = []
+
+    def define(self, name, kind, help):
+        """Declare a metric; kind is "counter", "gauge" or "histogram"."""
+        with self.lock:
+            if name not in self.definitions:
+                self.definitions[name] = (kind, help)
+                self.values[name] = {}
+
+    def add_collector(self, func):
+        with self.lock:
+            self.collectors.append(func)
+
+    def remove_collector(self, func):
+        with self.lock:
+            if func in self.collectors:
+                self.collectors.remove(func)
+
+    def inc(self, name, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.values[name][key] = self.values[name].get(key, 0) + amount
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.values[name][tuple(sorted(labels.items()))] = value
+
+    def observe(self, name, value, **labels):
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            h = self.values[name].get(key, None)
+            if h == None:
+                h = self.values[name][key] = Histogram()
+            h.observe(value)
+
+    def collect(self):
+        with self.lock:
+            for func in list(self.collectors):
+                func(self)
+
+    def get(self, name, **labels):
+        """Return one metric's value (or Histogram), or None if it hasn't been recorded."""
+        with self.lock:
+            return self.values[name].get(tuple(sorted(labels.items())), None)
+
+    def matching(self, name, labels):
+        """Return the values of a metric whose labels include all of the given ones."""
+        wanted = set(labels.items())
+        return [v for k, v in self.values[name].items() if wanted.issubset(k)]
+
+    def total(self, name, **labels):
+        """Return the sum of a counter or gauge over every label set that includes the given labels."""
+        with self.lock:
+            return sum(self.matching(name, labels))
+
+    def merged(self, name, **labels):
+        """Return a Histogram combining every label set of a histogram metric that includes the given labels, or None if there aren't any."""
+        with self.lock:
+            out = None
+            for h in self.matching(name, labels):
+                if out == None:
+                    out = Histogram(h.buckets)
+                out.counts = [a + b for a, b in zip(out.counts, h.counts)]
+                out.count += h.count
+                out.sum += h.sum
+            return out
+
+    def render(self):
+        """Return every metric in the prometheus text exposition format."""
+        self.collect()
+        lines = []
+        with self.lock:
+            for name in sorted(self.definitions.keys()):
+                kind, help = self.definitions[name]
+                lines.append(u"# HELP {} {}".format(name, help))
+                lines.append(u"# TYPE {} {}".format(name, kind))
+                for labels, value in sorted(self.values[name].items()):
+                    if kind != "histogram":
+                        lines.append(u"{}{} {}".format(name, format_labels(labels), format_value(value)))
+                        continue
+                    cumulative = 0
+                    for bound, n in zip(value.buckets + (float('inf'),), value.counts):
+                        cumulative += n
+                        lines.append(u"{}_bucket{} {}".format(name, format_labels(labels + (("le", format_value(bound)),)), cumulative))
+                    lines.append(u"{}_sum{} {}".format(name, format_labels(labels), repr(value.sum)))
+                    lines.append(u"{}_count{} {}".format(name, format_labels(labels), value.count))
+        return u"\n".join(lines) + u"\n"
+
+
+class TextfileExporter(object):
+    """Writes metrics to a file every interval seconds, for node_exporter's textfile collector (or anything else that reads prometheus text files).
+The file is written to a temporary name and renamed over the old one, so readers never see it half written.
+    """
+    def __init__(self, metrics, path, interval=15):
+        self.metrics = metrics
+        self.path = path
+        self.interval = interval
+        self.next_write = 0
+
+    def maybe_write(self, now=None):
+        """Write the file if interval seconds have passed since it was last written."""
+        if now is None:
+            now = time.time()
+        if now < self.next_write:
+            return
+        self.next_write = now + self.interval
+        self.write()
+
+    def write(self):
+        tmp = self.path + ".tmp"
+        with io.open(tmp, 'w', encoding='utf-8') as f:
+            f.write(self.metrics.render())
+        try:
+            os.rename(tmp, self.path)
+        except OSError: # windows won't rename over an existing file
+            os.remove(self.path)
+            os.rename(tmp, self.path)
+
+    def close(self):
+        pass
+
+
+class SocketExporter(object):
+    """Serves metrics on a unix domain socket: every connection gets the current metrics in prometheus text format, then is closed (try socat - UNIX-CONNECT:path)."""
+    def __init__(self, metrics, path):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("unix sockets aren't available on this platform")
+        self.metrics = metrics
+        self.path = path
+        remove_stale_socket(path) # left over from a previous run; refuses to touch anything else
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        self.sock.listen(5)
+        self.closed = False
+        self.thread = threading.Thread(target=self.serve, name="mqn metrics")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def serve(self):
+        while not self.closed:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.error:
+                break # closed
+            try:
+                conn.sendall(self.metrics.render().encode('utf-8'))
+            except socket.error:
+                pass
+            finally:
+                conn.close()
+
+    def maybe_write(self, now=None):
+        pass
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,282 +1,108 @@
 # a mqtt desktop notifier
 # author: Blake Oliver <oliver22213@me.com>
 
-import json
-import os
-from socket import gethostname
-import webbrowser
-import wx
-from wx import App
-from wx.adv import TaskBarIcon
-from paho.mqtt import client
-import pytoml
-import certifi
-import utils
-from constants import default_config, connect_codes
-
-
-
-class Mqn(TaskBarIcon):
-    def __init__(self, icon_name):
-        super(Mqn, self).__init__()
-        self.mqtt_connection_is_set_up = False
-        self.mqtt_connected = False
-        self.mqtt_loop_running = False
-        self.muted = False
-        self.icon_name = icon_name
-        self.SetIcon(wx.NullIcon, self.icon_name)
-        self.setup_config()
-        self.client = client.Client()
-        self.mqtt_setup_connection()
-        if self.config['mqn']['autoconnect'] == True:
-            self.mqtt_connect()
-
-    def setup_config(self):
-        self.user_config, self.config_file = utils.get_config()
-        # config checks...
-        if self.user_config == None:
-            m = wx.MessageDialog(parent=None, caption="No configuration file found", message="No configuration could be found for Mqn. Please create one and run this program again.")
-            m.ShowModal()
-            self.on_exit()
-            return
-        self.config = utils.combine_config(self.user_config, default_config)
-        if self.config.get('mqtt', None) == None:
-            m = wx.MessageDialog(parent=None, caption="Missing mqtt options", message="There is no 'mqtt' section in the configuration file.\nPlease specify one with your desired options and run this program again.")
-            m.ShowModal()
-            self.on_exit()
-            return
-        if self.config['mqtt'].get('host', None) == None:
-            m = wx.MessageDialog(parent=None, caption="No mqtt host specified", message="An mqtt host wasn't specified in the configuration file.\nPlease specify one and run this program again.")
-            m.ShowModal()
-            self.on_exit()
-            return
-        if self.config.get('topic', None) == None and self.config['mqn'].get('base_topic', None) == None:
-            m = wx.MessageDialog(parent=None, caption="No notification topics in config", message="No notification topics have been specified in the configuration file, and no base topic was set.\nYou must specify at least one topic for mqn to subscribe to, or a bas _topic.\nPlease do so, and then restart this program.")
-            m.ShowModal()
-            self.on_exit()
-            return
-        # all verification checks have passed
-        self.mqtt_subscriptions = {}
-        self.mqtt_message_ids = {}
-        if self.config['mqn'].get('base_topic', None) != None:
-            self.mqtt_subscriptions[self.config['mqn']['base_topic']] = {"subscribed": False}
-            if self.config['mqn'].get('directed_notifications', False) == True:
-                if self.config['mqn']['base_topic'].endswith('/'):
-                    m_topic = self.config['mqn']['base_topic']+gethostname().replace('+', '')
-                else:
-                    m_topic = self.config['mqn']['base_topic']+'/'+gethostname().replace('+', '')
-                self.mqtt_subscriptions[m_topic] = {"subscribed": False}
-        if self.config.get('topic', None) != None:
-            for sub in self.config['topic'].iterkeys():
-                self.mqtt_subscriptions[sub] = {"subscribed": False, "qos": self.config['topic'][sub].get('qos', 0)}
-
-    def mqtt_setup_connection(self, force=False, reload=False):
-        """Configures the mqtt broker connection with options set in config (host, port, ssl and specific args, username and pw)."""
-        if self.mqtt_connection_is_set_up == False or force==True:
-            if reload==True: 
-                self.client.reinitialise() # is it me or is that misspelled 
-            self.mqtt_loop_check()
-            if self.mqtt_loop_running == True or self.mqtt_connected == True:
-                self.mqtt_disconnect()
-            if self.config['mqtt'].get('username', None) != None:
-                if self.config['mqtt'].get('password', None) == None: # no password, just a username
-                    self.client.username_pw_set(self.config['mqtt']['username'])
-                else: # username and pw
-                    self.client.username_pw_set(self.config['mqtt']['username'], self.config['mqtt']['password'])
-            if self.config['mqtt']['ssl'] == True: # ssl is enabled for this broker connection
-                tls = {}
-                if self.config['mqtt']['ca_certs'].lower() == "auto":
-                    tls['ca_certs'] = certifi.where()
-                if self.config['mqtt'].get('certfile', None) != None:
-                    tls['certfile'] = self.config['mqtt']['certfile']
-                if self.config['mqtt'].get('keyfile', None) != None:
-                    tls['keyfile'] = self.config['mqtt']['keyfile']
-                self.client.tls_set(**tls)
-            if self.config.get('topic', None) != None:
-                for sub in self.mqtt_subscriptions.iterkeys():
-                    self.client.message_callback_add(sub, self.on_notification)
-            self.mqtt_connection_is_set_up = True
-
-    def mqtt_connect(self, start_loop=True):
-        """Establishes a connection to the mqtt broker specified in config, sets up subscription message handlers for all the specified topics, and starts the event processing loop for mqtt."""
-        if self.mqtt_connection_is_set_up == False:
-            self.mqtt_setup_connection()
-        if self.client.on_connect==None or self.client.on_disconnect==None:
-            self.mqtt_set_callbacks()
-        if self.mqtt_connected or self.mqtt_loop_running:
-            self.mqtt_disconnect()
-        self.client.connect(self.config['mqtt']['host'], self.config['mqtt']['port'], self.config['mqtt']['keepalive'])
-        if start_loop:
-            self.client.loop_start()
-            self.mqtt_loop_running = True
-
-    def mqtt_loop_check(self):
-        """Check to see if the mqtt event loop is alive, and set the value that reflects this on the class instance."""
-        # maybe make this a property so checking self.mqtt_loop_running will run this?
-        if getattr(self.client, '_thread', False) == False or self.client._thread == None: # the thread doesn't exist
-            self.mqtt_loop_running = False
-        else: # a thread does exist, determine it's running status
-            self.mqtt_loop_running = self.client._thread.is_alive()
-
-    def mqtt_set_callbacks(self):
-        self.client.on_connect = self.on_connect
-        self.client.on_disconnect = self.on_disconnect
-        self.client.on_subscribe = self.on_subscribe
-        self.client.on_unsubscribe = self.on_unsubscribe
-
-    def mqtt_disconnect(self):
-        """Disconnect from the mqtt broker if we're connected, and stop the mqtt event loop if it's running."""
-        if self.mqtt_connected:
-            self.client.disconnect()
-        self.mqtt_loop_check()
-        if self.mqtt_loop_running:
-            self.client.loop_stop()
-            self.mqtt_loop_running = False
-
-    def on_connect(self, c, u, f, r):
-        if r in connect_codes.keys():
-            self.set_status(connect_codes[r])
-            if r > 0:
-                self.mqtt_disconnect()
-                if self.muted == False:
-                    self.ShowBalloon("Connection failed to {}".format(self.config['mqtt']['host']), connect_codes[r])
-        else: # given code is unknown
-            self.mqtt_disconnect() # the previous call to this method only applies if the return code is from 0 to 5 (as there are no other codes on the constants dict)
-            self.set_status("connection refused (reason unknown)")
-            if self.muted == False:
-                self.ShowBalloon(title="Connection refused", text="The connection to {} was refused (reason unknown)".format(self.config['mqtt']['host']))
-        if r == 0:
-            self.mqtt_connected = True
-            # build a list of tuples of the form (subscription, qos)
-            # this helps consolidate what could be many subscriptions into just one request, rather than firing off each sub individually
-            subtuples = []
-            for subname, sub in self.mqtt_subscriptions.iteritems():
-                subtuples.append((subname, sub.get('qos', 0)))
-            r, mid = self.client.subscribe(subtuples)
-            # save the message ID we got for this request, so later on we can mark the specific topic(s) as subscribed or not.
-            self.mqtt_message_ids[mid] = [st[0] for st in subtuples] # build a list of just the subscriptions, not their qos values
-        if self.config['mqn']['quiet'] == False and self.muted == False:
-            self.ShowBalloon(title="Connected to mqtt broker", text="Connection established to {}".format(self.config['mqtt']['host']))
-        self.mqtt_loop_check()
-
-    def on_disconnect(self, c, u, r):
-        if r > 0:
-            self.set_status("disconnected unexpectedly, reconnecting soon")
-            if self.config['mqn']['quiet'] == False and self.muted == False:
-                self.ShowBalloon(title="Unexpectedly disconnected from {}".format(self.config['mqtt']['host']), text="Connection to the mqtt broker has been lost; trying to reconnect soon.")
+import argparse
+import signal
+import sys
+import time
+
+
+def sync_brokers(engines, sinks, loop, metrics):
+    """Start an engine for each [broker."name"] table in the main engine's config that doesn't have one yet, and shut down the engines for tables that are gone. Returns the new list of engines (the main one first)."""
+    from engine import MqnEngine, ConfigError
+    names = set(engines[0].config.get('broker', {}).keys())
+    kept = [engines[0]]
+    for m in engines[1:]:
+        if m.broker_name in names:
+            kept.append(m)
         else:
-            self.mqtt_connected = False
-            self.set_status("disconnected")
-            if self.config['mqn']['quiet'] == False and self.muted==False:
-                self.ShowBalloon(title="Disconnected from mqtt broker", text="disconnected from {}".format(self.config['mqtt']['host']))
-        self.mqtt_loop_check()
-
-    def on_subscribe(self, c, u, mid, qos):
-        """Callback that gets called when a requested subscription is granted by the broker. Updates a dict so other code can check the subscribed status of topics."""
-        subs = self.mqtt_message_ids[mid]
-        for sub in subs:
-            self.mqtt_subscriptions[sub]['subscribed']= True
-        del(self.mqtt_message_ids[mid]) # acknowledged, no need to waist space
-
-    def on_unsubscribe(self, c, u, mid):
-        """Callback that gets called when an unsubscribe request is granted by the broker. Updates a dict so other code can check the subscribed status of topics."""
-        subs = self.mqtt_message_ids[mid]
-        for sub in subs:
-            self.mqtt_subscriptions[sub]['subscribed'] = False
-        del(self.mqtt_message_ids[mid])
-
-    def on_notification(self, c, u, msg):
+            m.shutdown()
+    running = set(m.broker_name for m in kept)
+    for name in sorted(names - running):
         try:
-            m = json.loads(msg.payload)
-            if m.get('type', None) == 'notification' and m.get('title', False) and m.get('message', False) and self.muted == False:
-                self.ShowBalloon(m['title'], m['message'])
-        except ValueError as e:
-            pass # not a valid mqn message
-
-    def CreatePopupMenu(self):
-        menu = wx.Menu()
-        utils.create_menu_item(menu, "connect", self.do_menu_connect, kind=wx.ITEM_CHECK).Check(self.mqtt_connected) # if we're connected to the broker, this is checked
-        utils.create_menu_item(menu, "mute notifications", self.toggle_mute, kind=wx.ITEM_CHECK).Check(self.muted)
-        topics_submenu = wx.Menu()
-        for subname, sub in self.mqtt_subscriptions.iteritems():
-            utils.create_menu_item(topics_submenu, subname, self.toggle_subscription, bind_to=menu, kind=wx.ITEM_CHECK).Check(sub['subscribed'])
-        menu.AppendSubMenu(topics_submenu, "topics").Enable(self.mqtt_connected)
-        utils.create_menu_item(menu, "open configuration file", self.open_config)
-        utils.create_menu_item(menu, "&reload configuration file", self.reload_config)
-        utils.create_menu_item(menu, "open mqn &website", self.open_website)
-        utils.create_menu_item(menu, "e&xit", self.on_exit)
-        return menu
-
-    def set_status(self, status=""):
-        """Method that sets a small status message next to the icon's name in the system tray.
-If status is an empty string (which is the default), then set the name of the icon to what this class was instantiated with.
-        """
-        try:
-            if status == '':
-                self.SetIcon(wx.NullIcon, self.icon_name)
-            else:
-                self.SetIcon(wx.NullIcon, """{}: {}""".format(self.icon_name, status))
-        except RuntimeError as e:
-            pass
-
-    def do_menu_connect(self, event=None):
-        """Connect or disconnect from the configured mqtt broker."""
-        # no matter what the menu item's checked status says, this method will properly open or close a connection to the configured broker
-        # I do it this way because (unlikely though it is), the connection status can change while a menu is open;
-        # so if this method acts based on that, it could run connect (when there is already one established), and cause a reconnect, which would require another usage of this method to fix
-        # or it could run disconnect, when there is no connection to the broker, thus doing nothing
-        if self.mqtt_connected == True: # disconnect
-            self.mqtt_disconnect()
-        elif self.mqtt_connected == False: # connect
-            self.mqtt_connect()
-
-    def toggle_mute(self, event):
-        self.muted = not self.muted
-
-    def toggle_subscription(self, event):
-        sub = event.GetEventObject().FindItemById(event.GetId()).GetItemLabelText()
-        if self.mqtt_subscriptions[sub]['subscribed'] == True:
-            r, mid = self.client.unsubscribe(sub)
-            self.mqtt_message_ids[mid] = [sub]
-        elif self.mqtt_subscriptions[sub]['subscribed'] == False:
-            r, mid = self.client.subscribe(sub, self.mqtt_subscriptions[sub].get('qos', 0))
-            self.mqtt_message_ids[mid] = [sub]
-
-    def open_website(self, event=None):
-        webbrowser.open("https://github.com/oliver2213/mqn")
-
-    def open_config(self, event=None):
-        os.startfile(self.config_file)
-
-    def reload_config(self, event=None):
-        self.setup_config()
-        # disconnect if necessary, stop the mqtt event loop, reset settings from config, and reconnect again
-        self.mqtt_disconnect()
-        self.mqtt_setup_connection(force=True, reload=True)
-        if self.config['mqn']['autoconnect'] == True:
-            self.mqtt_connect()
-        wx.MessageDialog(parent=None, caption="config reloaded", message="The configuration file has been reloaded and the connection to your configured mqtt broker is being reestablished according to the updated config.").ShowModal()
-
-    def on_exit(self, event=None):
-        self.mqtt_disconnect() # will only disconnect if it needs doing, and stops mqtt's loop as well if necessary
-        wx.CallAfter(self.Destroy)
-
-def main():
-    m = None
-    app = App()
+            kept.append(MqnEngine(sinks, broker=name, network_loop=loop, metrics=metrics))
+        except ConfigError as e:
+            sys.stderr.write("{}: {}\n".format(e.caption, e.message))
+    return kept
+
+def run_headless(sink_specs, relay=None):
+    """Run mqn without a user interface, passing notifications to the given sinks (see sinks.create_sink) until interrupted.
+If relay is a path, the main broker connection is also shared with other mqn processes on this host through a unix socket there.
+    """
+    from engine import MqnEngine, ConfigError
+    from netloop import NetworkLoop
+    from metrics import Metrics
+    from sinks import create_sink
     try:
-        m = Mqn("mqn")
-        app.MainLoop()
+        sinks = [create_sink(spec) for spec in sink_specs]
+    except (ValueError, IOError) as e:
+        sys.stderr.write("{}\n".format(e))
+        return 2
+    # every broker connection is serviced from the same network thread, and records into the same metrics
+    loop = NetworkLoop()
+    metrics = Metrics()
+    engines = []
+    try:
+        engines.append(MqnEngine(sinks, network_loop=loop, metrics=metrics, relay=relay))
+        for name in engines[0].config.get('broker', {}).keys():
+            engines.append(MqnEngine(sinks, broker=name, network_loop=loop, metrics=metrics))
     except Exception as e:
-        #print("""Unhandled exception:\n{}""".format(str(e)))
-        #raise
-        wx.MessageDialog(parent=None, caption="Error!", message="""{}: {}""".format(type(e).__name__, e)).ShowModal()
-        return
+        if isinstance(e, ConfigError):
+            sys.stderr.write("{}: {}\n".format(e.caption, e.message))
+        else:
+            sys.stderr.write("{}: {}\n".format(type(e).__name__, e))
+        for m in engines:
+            m.shutdown()
+        loop.stop()
+        return 1
+    # treat SIGTERM (from a service manager or container runtime) like ctrl+c, so we disconnect cleanly
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    interval = engines[0].config['mqn']['dispatch_interval'] / 1000.0
+    next_config_check = time.time()
+    try:
+        while True:
+            for m in engines:
+                m.dispatch_pending()
+            if engines[0].config['mqn']['watch_config'] == True and time.time() >= next_config_check:
+                next_config_check = time.time() + engines[0].config['mqn']['watch_interval']
+                try:
+                    if engines[0].check_config(): # brokers may have been added or removed
+                        engines = sync_brokers(engines, sinks, loop, metrics)
+                except ConfigError as e:
+                    sys.stderr.write("{}: {}\nThe previous configuration is still being used.\n".format(e.caption, e.message))
+                for m in engines[1:]:
+                    try:
+                        m.check_config()
+                    except ConfigError as e:
+                        sys.stderr.write("{}: {}\nThe previous configuration is still being used.\n".format(e.caption, e.message))
+            time.sleep(interval)
+    except (KeyboardInterrupt, SystemExit):
+        pass
     finally:
-        # gracefully disconnect, even if an exception is thrown
-        if m != None and getattr(m, 'client', False) and m.mqtt_connected==True: # if there is an mqn object, if it has an mqtt client, and it indicates that it is still connected to a broker
-            m.mqtt_disconnect()
+        for m in engines:
+            m.shutdown()
+        loop.stop()
+        for sink in sinks:
+            sink.close()
+    return 0
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="mqn", description="Desktop notifications from mqtt messages.")
+    parser.add_argument("--headless", action="store_true", help="run without the system tray icon (and without loading wx)")
+    parser.add_argument("--sink", action="append", dest="sinks", metavar="SINK", help="where notifications go in headless mode: stdout, json, log:PATH, jsonlog:PATH or libnotify; can be given more than once (default: stdout)")
+    parser.add_argument("--relay", metavar="PATH", help="in headless mode, share the broker connection with other mqn processes on this host through a unix socket at PATH")
+    args = parser.parse_args(argv)
+    if args.headless:
+        return run_headless(args.sinks or ["stdout"], args.relay)
+    if args.sinks:
+        parser.error("--sink can only be used with --headless")
+    if args.relay:
+        parser.error("--relay can only be used with --headless")
+    # only pull in wx when the tray icon is actually wanted
+    import tray
+    tray.main()
+    return 0
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    sys.exit(main())
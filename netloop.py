@@ -0,0 +1,241 @@
+# a single-threaded network loop for mqtt connections
+
+import errno
+import os
+import select
+import socket
+import stat
+import sys
+import threading
+import time
+import traceback
+from collections import deque
+
+# the states an engine's broker connection moves through; the network loop advances them
+STATE_DISCONNECTED = "disconnected" # not being serviced by a network loop at all
+STATE_WAITING = "waiting to reconnect" # waiting until mqtt_next_attempt before trying to connect
+STATE_CONNECTING = "connecting" # socket open and CONNECT sent, waiting for the broker's CONNACK
+STATE_CONNECTED = "connected"
+STATE_DISCONNECTING = "disconnecting" # DISCONNECT queued, waiting for the socket to close
+
+
+def socketpair():
+    """Return a pair of connected sockets; socket.socketpair isn't available on windows under python 2, so fall back to a loopback connection."""
+    if hasattr(socket, 'socketpair'):
+        return socket.socketpair()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    a = socket.create_connection(listener.getsockname())
+    b, addr = listener.accept()
+    listener.close()
+    return a, b
+
+
+def remove_stale_socket(path):
+    """Make way for a unix socket to be created at path: if a socket left over from a previous run is there (one nothing is listening on), remove it.
+Raises ValueError if something else is at path (a regular file, say, from a typo), or a running process is still listening on it, rather than deleting it.
+    """
+    try:
+        st = os.lstat(path)
+    except OSError: # nothing there
+        return
+    if not stat.S_ISSOCK(st.st_mode):
+        raise ValueError("{} already exists and isn't a socket".format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except socket.error as e:
+        if e.errno not in (errno.ECONNREFUSED, errno.ENOENT):
+            raise ValueError("{} couldn't be checked: {}".format(path, e))
+        if e.errno == errno.ECONNREFUSED:
+            os.remove(path)
+        return
+    finally:
+        probe.close()
+    raise ValueError("{} is in use by another running process".format(path))
+
+
+class NetworkLoop(object):
+    """Services any number of mqtt broker connections (MqnEngine instances) from one thread.
+Rather than a paho network thread per connection, this selects on every open socket and drives each client through paho's external event loop interface: on_socket_open and on_socket_close keep track of sockets, on_socket_register_write wakes the loop when something is queued to send, and loop_read, loop_write and loop_misc do the actual work.
+Engines reconnect by going back to STATE_WAITING; the loop connects them again once their mqtt_next_attempt time has passed. Connected engines get their mqtt_service method called on every pass, for anything else that needs doing on a timer.
+Connecting itself still blocks the loop (for at most paho's connect timeout), since paho doesn't offer a non-blocking connect.
+An exception from one engine (in a command, a paho callback wrapped with guard(), or its own servicing) is logged and costs only that engine its connection, which reconnects as if it had been lost; the loop keeps going for everyone else.
+    """
+    def __init__(self, timeout=1.0):
+        self.timeout = timeout # longest time to wait in select, so keepalives are handled promptly
+        self.engines = []
+        self.sockets = {} # socket -> engine
+        self.commands = deque() # functions to run on the loop thread
+        self.wake_r, self.wake_w = socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.thread = None
+        self.stopping = False
+
+    @property
+    def running(self):
+        return self.thread != None and self.thread.is_alive()
+
+    def on_loop_thread(self):
+        return threading.current_thread() == self.thread
+
+    def start(self):
+        if not self.running:
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run, name="mqn network")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def stop(self):
+        """Stop the loop thread. Engines should be disconnected first."""
+        self.stopping = True
+        self.wake()
+        if self.running and not self.on_loop_thread():
+            self.thread.join()
+
+    def wake(self):
+        """Interrupt the loop's select, so it notices new commands or data to write."""
+        try:
+            self.wake_w.send(b'x')
+        except socket.error: # the buffer is full, so the loop has plenty of wakeups waiting already
+            pass
+
+    def call(self, func, *args):
+        """Run func on the loop thread (or right away, if we're already on it or the loop isn't running)."""
+        if self.on_loop_thread() or not self.running:
+            func(*args)
+        else:
+            self.commands.append((func, args))
+            self.wake()
+
+    def add(self, engine):
+        """Start servicing engine's connection, and start the loop thread if it isn't running."""
+        engine.client.on_socket_open = self.on_socket_open
+        engine.client.on_socket_close = self.on_socket_close
+        engine.client.on_socket_register_write = self.on_socket_register_write
+        engine.client.user_data_set(engine)
+        self.call(self._add, engine)
+        self.start()
+
+    def _add(self, engine):
+        if engine not in self.engines:
+            self.engines.append(engine)
+
+    def discard(self, engine):
+        """Stop servicing engine's connection. Must be called on the loop thread (the engine does this itself once it's disconnected)."""
+        if engine in self.engines:
+            self.engines.remove(engine)
+        for sock, e in list(self.sockets.items()):
+            if e == engine:
+                del(self.sockets[sock])
+
+    def on_socket_open(self, c, engine, sock):
+        self.sockets[sock] = engine
+
+    def on_socket_close(self, c, engine, sock):
+        self.sockets.pop(sock, None)
+
+    def on_socket_register_write(self, c, engine, sock):
+        # may be called from any thread that publishes or subscribes
+        if not self.on_loop_thread():
+            self.wake()
+
+    def guard(self, engine, callback, drop=False):
+        """Wrap one of engine's paho callbacks so an exception in it is handled by failed(), rather than unwinding through paho (which would leave the packet being handled to be handled again on the next read).
+If drop is True (for on_message), the exception is only logged and the packet dropped: paho acknowledges a QoS 1 message once the callback returns, so failing the connection instead would have the broker redeliver the same message, and fail again, on every reconnect."""
+        def guarded(*args):
+            try:
+                return callback(*args)
+            except Exception:
+                what = "handling {} for {}".format(callback.__name__, engine.metrics_broker)
+                if drop:
+                    sys.stderr.write("mqn: error in the network loop while {} (dropped it):\n".format(what))
+                    traceback.print_exc()
+                else:
+                    self.failed(engine, what)
+        return guarded
+
+    def failed(self, engine, what):
+        """Handle an exception raised while servicing engine (or running a command for it, if engine isn't None): log it, and drop the engine's connection so it goes through mqtt_connection_closed and reconnects, rather than being left half-updated."""
+        sys.stderr.write("mqn: error in the network loop while {}:\n".format(what))
+        traceback.print_exc()
+        if engine == None:
+            return
+        sock = engine.client.socket()
+        if sock != None:
+            # the client notices on its next read (select reports the socket readable) and closes its side, and the end of that pass calls mqtt_connection_closed
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, OSError):
+                pass
+        elif engine.mqtt_state == STATE_DISCONNECTING: # it was going anyway
+            self.discard(engine)
+            engine.mqtt_state = STATE_DISCONNECTED
+            engine.mqtt_idle.set()
+        elif engine.mqtt_state != STATE_DISCONNECTED: # back off, rather than failing the same way again straight away
+            engine.mqtt_retry_later()
+
+    def run(self):
+        while not self.stopping:
+            while self.commands:
+                func, args = self.commands.popleft()
+                try:
+                    func(*args)
+                except Exception:
+                    engine = getattr(func, '__self__', None) # commands are usually an engine's methods
+                    self.failed(engine if engine in self.engines else None, "running {}".format(getattr(func, '__name__', func)))
+            now = time.time()
+            timeout = self.timeout
+            for engine in list(self.engines):
+                try:
+                    if engine.mqtt_state == STATE_WAITING:
+                        if now >= engine.mqtt_next_attempt:
+                            engine.mqtt_attempt_connect()
+                        else:
+                            timeout = min(timeout, engine.mqtt_next_attempt - now)
+                    elif engine.mqtt_state == STATE_CONNECTED:
+                        wait = engine.mqtt_service(now)
+                        if wait != None:
+                            timeout = min(timeout, wait)
+                except Exception:
+                    self.failed(engine, "servicing {}".format(engine.metrics_broker))
+            socks = list(self.sockets.keys())
+            wsocks = [s for s in socks if self.sockets[s].client.want_write()]
+            # ssl sockets can hold decrypted data select doesn't know about
+            pending = [s for s in socks if getattr(s, 'pending', None) != None and s.pending() > 0]
+            if pending:
+                timeout = 0
+            try:
+                r, w, x = select.select([self.wake_r]+socks, wsocks, [], max(0, timeout))
+            except (select.error, socket.error, ValueError): # a socket was closed under us; the checks below will notice
+                r, w = [], []
+            if self.wake_r in r:
+                try:
+                    while self.wake_r.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+            for sock in set(r).union(pending):
+                engine = self.sockets.get(sock, None)
+                if engine != None:
+                    try:
+                        engine.client.loop_read()
+                    except Exception:
+                        self.failed(engine, "reading from {}".format(engine.metrics_broker))
+            for sock in w:
+                engine = self.sockets.get(sock, None) # reading may have closed it
+                if engine != None:
+                    try:
+                        engine.client.loop_write()
+                    except Exception:
+                        self.failed(engine, "writing to {}".format(engine.metrics_broker))
+            for engine in list(self.engines):
+                try:
+                    if engine.mqtt_state in (STATE_CONNECTING, STATE_CONNECTED, STATE_DISCONNECTING):
+                        engine.client.loop_misc() # keepalive pings, and noticing when they go unanswered
+                        if engine.client.socket() == None:
+                            engine.mqtt_connection_closed()
+                except Exception:
+                    self.failed(engine, "servicing {}".format(engine.metrics_broker))
@@ -0,0 +1,90 @@
+# reconnect scheduling
+
+import random
+import time
+
+
+class Broker(object):
+    """A broker mqn can connect to, along with how healthy it has been recently."""
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.failures = 0 # consecutive failures; reset when a connection is accepted
+        self.down_until = 0 # don't prefer this broker again until this time
+        self.last_failure = None
+        self.last_connected = None
+
+    def __str__(self):
+        if self.port == None: # a relay socket, rather than a network address
+            return self.host
+        return "{}:{}".format(self.host, self.port)
+
+    @classmethod
+    def from_spec(cls, spec, default_port):
+        """Create a broker from a string of the form host or host:port."""
+        host, sep, port = spec.rpartition(':')
+        if sep == "" or not port.isdigit(): # no port given (or an ipv6 address without one)
+            return cls(spec, default_port)
+        return cls(host, int(port))
+
+
+class ReconnectScheduler(object):
+    """Decides when, and to which broker, mqn should try to reconnect.
+Delays grow exponentially from min_delay up to max_delay with each consecutive failure, and are picked at random between min_delay and that cap (jitter), so a fleet of clients that lost the same broker at the same time don't all come back at once.
+Refused connections (bad credentials, not authorized and so on) won't fix themselves quickly, so they count as several failures at once.
+Brokers are tried in order; a broker that fails is avoided until its own backoff runs out, and the first healthy one is preferred.
+    """
+    # connack codes that mean retrying right away is pointless; see constants.connect_codes
+    refused_codes = (1, 2, 4, 5)
+
+    def __init__(self, brokers, min_delay=1, max_delay=120, refused_penalty=3):
+        self.brokers = brokers
+        self.min_delay = min_delay
+        self.max_delay = max(min_delay, max_delay)
+        self.refused_penalty = refused_penalty
+        self.index = 0
+        self.reconnects = 0
+
+    def current(self):
+        """Return the broker that should be tried next."""
+        return self.brokers[self.index]
+
+    def backoff(self, failures):
+        """Return the longest delay for the given number of consecutive failures."""
+        return min(self.max_delay, self.min_delay * 2 ** min(failures, 32))
+
+    def connected(self, now=None):
+        """Record that the current broker accepted our connection."""
+        if now is None:
+            now = time.time()
+        broker = self.current()
+        broker.failures = 0
+        broker.down_until = 0
+        broker.last_connected = now
+
+    def failed(self, code=None, now=None):
+        """Record a failed connection attempt (or a dropped connection) to the current broker, pick the broker to try next, and return how many seconds to wait before trying it.
+Code is the connack return code if the broker refused the connection, or None for network errors and dropped connections.
+        """
+        if now is None:
+            now = time.time()
+        broker = self.current()
+        broker.failures += 1
+        if code in self.refused_codes:
+            broker.failures += self.refused_penalty
+        broker.last_failure = now
+        broker.down_until = now + self.backoff(broker.failures)
+        self.reconnects += 1
+        # the first broker in order that isn't being avoided, or failing that, the one that will be available soonest
+        healthy = [i for i, b in enumerate(self.brokers) if b.down_until <= now]
+        if healthy:
+            self.index = healthy[0]
+        else:
+            self.index = min(range(len(self.brokers)), key=lambda i: self.brokers[i].down_until)
+        nxt = self.current()
+        # back off according to how the next broker has been doing, spread at random so clients don't reconnect in lockstep
+        return random.uniform(self.min_delay, self.backoff(max(nxt.failures, 1)))
+
+    def stats(self):
+        """Return a list of dicts describing the health of each broker."""
+        return [{"broker": str(b), "failures": b.failures, "down_until": b.down_until, "last_failure": b.last_failure, "last_connected": b.last_connected} for b in self.brokers]
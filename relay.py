@@ -0,0 +1,476 @@
+# sharing one broker connection between several mqn processes on the same host
+
+import base64
+import errno
+import json
+import os
+import select
+import socket
+import threading
+from topictrie import TopicTrie
+from subscriptions import SUBACK_FAILURE
+from netloop import socketpair, remove_stale_socket
+
+text_type = type(u"")
+try:
+    long_type = long
+except NameError: # python 3
+    long_type = int
+
+# the relay protocol is one json object per line, each with an "op":
+# client to relay: subscribe (mid, topics: [[filter, qos], ...]), unsubscribe (mid, topics: [filter, ...])
+# relay to client: connack (rc), suback (mid, granted: [qos, ...]), unsuback (mid), message (topic, payload in base64, qos, retain)
+
+
+def encode(obj):
+    return (json.dumps(obj) + "\n").encode('utf-8')
+
+def is_int(value):
+    return isinstance(value, (int, long_type)) and not isinstance(value, bool)
+
+def valid_filter(topic_filter):
+    """Return True if topic_filter is a string and a valid mqtt topic filter (wildcards only as whole levels, and # only at the end)."""
+    if not isinstance(topic_filter, (str, text_type)) or topic_filter == "":
+        return False
+    levels = topic_filter.split('/')
+    for i, level in enumerate(levels):
+        if ('+' in level or '#' in level) and len(level) > 1:
+            return False
+        if level == '#' and i != len(levels) - 1:
+            return False
+    return True
+
+def parse_request(message):
+    """Check a request from a relay client, returning (op, mid, topics); topics is a list of (filter, qos) tuples for a subscribe, and of filters for an unsubscribe.
+Raises ValueError if it isn't a request the relay understands, so nothing a client sends can reach the network loop unchecked.
+    """
+    if not isinstance(message, dict):
+        raise ValueError("requests must be objects")
+    op, mid, topics = message.get('op', None), message.get('mid', None), message.get('topics', None)
+    if op not in ("subscribe", "unsubscribe"):
+        raise ValueError("unknown op")
+    if not is_int(mid) or not 0 < mid <= 65535:
+        raise ValueError("mid must be an integer from 1 to 65535")
+    if not isinstance(topics, list) or not topics:
+        raise ValueError("topics must be a non-empty list")
+    if op == "unsubscribe":
+        if not all(valid_filter(f) for f in topics):
+            raise ValueError("invalid topic filter")
+        return op, mid, list(topics)
+    subtuples = []
+    for t in topics:
+        if not isinstance(t, list) or len(t) != 2 or not valid_filter(t[0]) or not is_int(t[1]) or not 0 <= t[1] <= 2:
+            raise ValueError("topics must be [filter, qos] pairs, with a qos from 0 to 2")
+        subtuples.append((t[0], t[1]))
+    return op, mid, subtuples
+
+
+class LineSocket(object):
+    """A non-blocking socket carrying the relay protocol, with buffers in both directions."""
+    def __init__(self, sock, max_buffer=1 << 20):
+        self.sock = sock
+        self.sock.setblocking(False)
+        self.inbuf = b''
+        self.outbuf = bytearray()
+        self.max_buffer = max_buffer # most bytes that can be waiting to be sent, or received without the end of a line
+        self.lock = threading.Lock() # outbuf is appended to from other threads
+        self.closed = False
+
+    def send(self, data, droppable=False):
+        """Queue data to be sent. If droppable and the buffer is full (the other end isn't keeping up), it's discarded instead, returning False."""
+        with self.lock:
+            if droppable and len(self.outbuf) + len(data) > self.max_buffer:
+                return False
+            self.outbuf += data
+            return True
+
+    def want_write(self):
+        return len(self.outbuf) > 0
+
+    def read(self):
+        """Read what's available and return a list of the complete messages received. Raises EOFError when the other end has gone, or has sent more than max_buffer bytes without ending a line."""
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise EOFError()
+        if not data:
+            raise EOFError()
+        self.inbuf += data
+        messages = []
+        while b'\n' in self.inbuf:
+            line, self.inbuf = self.inbuf.split(b'\n', 1)
+            try:
+                messages.append(json.loads(line.decode('utf-8')))
+            except ValueError: # not something we understand; ignore it rather than dropping the connection
+                continue
+        if len(self.inbuf) > self.max_buffer: # no line is ever that long; don't buffer it forever
+            raise EOFError()
+        return messages
+
+    def write(self):
+        with self.lock:
+            if not self.outbuf:
+                return
+            try:
+                sent = self.sock.send(bytes(self.outbuf[:65536]))
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return
+                raise EOFError()
+            del(self.outbuf[:sent])
+
+    def close(self):
+        self.closed = True
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class RelayConnection(LineSocket):
+    """A local client's connection to the relay, as the relay sees it."""
+    def __init__(self, sock, max_buffer=1 << 20):
+        super(RelayConnection, self).__init__(sock, max_buffer)
+        self.filters = {} # topic filter -> qos this client asked for
+        self.pending = {} # mid -> [(filter, qos), ...], subscribe requests waiting on the broker
+        self.dropped = 0 # messages discarded because this client wasn't reading them
+
+
+class RelayServer(object):
+    """Shares an engine's broker connection with other mqn processes on this host, over a unix domain socket.
+Local clients (engines configured with relay = "path" in their mqtt section, which connect through RelayClient) ask for topic filters just as they would a broker. The relay subscribes to each filter on the broker once, however many clients want it, answers each client's request once the broker has answered (passing on refusals), and forwards every message from the broker to the clients whose filters match it. Filters nobody wants any more are unsubscribed, unless the engine subscribes to them for itself.
+Socket input and output happens on the relay's own thread; everything to do with subscriptions happens on the engine's network loop thread, like the engine's own subscription handling.
+A client that doesn't keep up has messages discarded once max_buffer bytes are waiting for it, rather than holding up everyone else.
+    """
+    def __init__(self, path, engine, mode=0o660, max_buffer=1 << 20):
+        if not hasattr(socket, 'AF_UNIX'):
+            raise ValueError("unix sockets aren't available on this platform")
+        self.path = path
+        self.engine = engine
+        self.max_buffer = max_buffer
+        self.clients = []
+        self.trie = TopicTrie() # filter -> set of RelayConnections that want it
+        self.qos = {} # filter -> qos it's subscribed to on the broker with
+        self.granted = {} # filter -> qos the broker granted, or SUBACK_FAILURE
+        self.requested = set() # filters asked of the broker but not answered yet
+        self.messages = 0 # messages forwarded to clients
+        self.dropped = 0
+        remove_stale_socket(path) # left over from a previous run
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.bind(path)
+        os.chmod(path, mode)
+        self.sock.listen(16)
+        self.sock.setblocking(False)
+        self.wake_r, self.wake_w = socketpair()
+        self.wake_r.setblocking(False)
+        self.wake_w.setblocking(False)
+        self.closed = False
+        self.thread = threading.Thread(target=self.run, name="mqn relay")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def wake(self):
+        try:
+            self.wake_w.send(b'x')
+        except socket.error:
+            pass
+
+    def run(self):
+        while not self.closed:
+            clients = list(self.clients)
+            try:
+                r, w, x = select.select([self.sock, self.wake_r] + [c.sock for c in clients], [c.sock for c in clients if c.want_write()], [], 1.0)
+            except (select.error, socket.error, ValueError):
+                r, w = [], []
+            if self.closed:
+                break
+            if self.wake_r in r:
+                try:
+                    while self.wake_r.recv(4096):
+                        pass
+                except socket.error:
+                    pass
+            if self.sock in r:
+                self.accept()
+            for c in clients:
+                try:
+                    if c.sock in r:
+                        for message in c.read():
+                            self.handle(c, message)
+                            if c.closed: # disconnected for a bad request
+                                break
+                    if c.closed:
+                        continue
+                    if c.sock in w:
+                        c.write()
+                except EOFError:
+                    self.disconnected(c)
+
+    def accept(self):
+        try:
+            sock, addr = self.sock.accept()
+        except socket.error:
+            return
+        c = RelayConnection(sock, self.max_buffer)
+        self.clients.append(c)
+        c.send(encode({"op": "connack", "rc": 0}))
+
+    def disconnected(self, c):
+        if c in self.clients:
+            self.clients.remove(c)
+        c.close()
+        self.engine.network_loop.call(self._forget, c, list(c.filters.keys()))
+
+    def handle(self, c, message):
+        try:
+            op, mid, topics = parse_request(message)
+        except ValueError: # a client that sends nonsense is disconnected, rather than trusted with anything else
+            self.disconnected(c)
+            return
+        if op == "subscribe":
+            self.engine.network_loop.call(self._subscribe, c, mid, topics)
+        else:
+            self.engine.network_loop.call(self._unsubscribe, c, mid, topics)
+
+    # the methods below run on the engine's network loop thread
+
+    def _subscribe(self, c, mid, topics):
+        if c.closed:
+            return
+        new = []
+        for f, qos in topics:
+            clients = self.trie.get(f, None)
+            if clients == None:
+                clients = set()
+                self.trie.add(f, clients)
+            clients.add(c)
+            c.filters[f] = qos
+            if self.granted.get(f, None) == SUBACK_FAILURE: # the client is retrying; so should we
+                del(self.granted[f])
+            own = self.engine.mqtt_subscriptions.get(f, None)
+            if f not in self.granted and own != None and own['subscribed']:
+                self.granted[f] = own.get('qos', 0)
+            if f not in self.granted and f not in self.requested:
+                self.qos[f] = max(qos, self.qos.get(f, 0), own.get('qos', 0) if own != None else 0) # never downgrade one of the engine's own topics
+                new.append((f, self.qos[f]))
+            elif own == None and qos > self.qos.get(f, 0): # subscribe again at the higher qos; this client is answered with what's granted now
+                self.qos[f] = qos
+                new.append((f, qos))
+        c.pending[mid] = topics
+        self.answer(c)
+        if new:
+            self.requested.update(f for f, qos in new)
+            self.engine._mqtt_subscribe(new)
+
+    def answer(self, c):
+        """Send the client a SUBACK for each of its requests the broker has now answered."""
+        for mid, topics in list(c.pending.items()):
+            if not all(f in self.granted for f, qos in topics):
+                continue
+            del(c.pending[mid])
+            granted = [SUBACK_FAILURE if self.granted[f] == SUBACK_FAILURE else min(qos, self.granted[f]) for f, qos in topics]
+            c.send(encode({"op": "suback", "mid": mid, "granted": granted}))
+        self.wake()
+
+    def _unsubscribe(self, c, mid, topics):
+        self._forget(c, topics)
+        c.send(encode({"op": "unsuback", "mid": mid}))
+        self.wake()
+
+    def _forget(self, c, topics):
+        unsubscribe = []
+        for f in topics:
+            c.filters.pop(f, None)
+            clients = self.trie.get(f, None)
+            if clients == None:
+                continue
+            clients.discard(c)
+            if clients:
+                continue
+            self.trie.remove(f)
+            self.qos.pop(f, None)
+            self.requested.discard(f)
+            if f not in self.engine.mqtt_subscriptions: # the engine still wants its own topics
+                self.granted.pop(f, None)
+                unsubscribe.append(f)
+        if unsubscribe and self.engine.mqtt_connected:
+            self.engine._mqtt_unsubscribe(unsubscribe)
+
+    def wants(self, topic_filter):
+        """Return True if any client is subscribed to topic_filter."""
+        return bool(self.trie.get(topic_filter, None))
+
+    def subscriptions(self):
+        """Return (filter, qos) tuples for everything clients want that the engine doesn't subscribe to itself; subscribed to on every connect along with the engine's own topics."""
+        subtuples = [(f, qos) for f, qos in self.qos.items() if f not in self.engine.mqtt_subscriptions]
+        self.requested.update(f for f, qos in subtuples)
+        return subtuples
+
+    def acknowledged(self, topic_filter, granted):
+        """Called by the engine for each filter in a SUBACK from the broker."""
+        if not self.wants(topic_filter):
+            return
+        self.requested.discard(topic_filter)
+        self.granted[topic_filter] = granted
+        for c in list(self.trie.get(topic_filter)):
+            self.answer(c)
+
+    def connection_lost(self):
+        """Called by the engine when its broker connection closes; everything is subscribed again when it reconnects."""
+        self.granted = {}
+        self.requested = set()
+
+    def publish(self, msg):
+        """Forward a message from the broker to every client with a matching filter. Called by the engine for every message it receives."""
+        matches = self.trie.match(msg.topic)
+        if not matches:
+            return
+        clients = set()
+        for f, c in matches:
+            clients.update(c)
+        data = encode({"op": "message", "topic": msg.topic, "payload": base64.b64encode(msg.payload).decode('ascii'), "qos": msg.qos, "retain": bool(msg.retain)})
+        for c in clients:
+            if c.send(data, droppable=True):
+                self.messages += 1
+            else:
+                c.dropped += 1
+                self.dropped += 1
+        self.wake()
+
+    def close(self):
+        self.closed = True
+        self.wake()
+        if self.thread.is_alive() and threading.current_thread() != self.thread:
+            self.thread.join()
+        for c in list(self.clients):
+            c.close()
+        self.clients = []
+        self.sock.close()
+        self.wake_r.close()
+        self.wake_w.close()
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class RelayMessage(object):
+    """A message forwarded by the relay, with the attributes of paho's MQTTMessage that mqn uses."""
+    def __init__(self, topic, payload, qos, retain):
+        self.topic = topic
+        self.payload = payload
+        self.qos = qos
+        self.retain = retain
+        self.dup = False # the relay connection is local and reliable, so nothing is ever redelivered over it
+
+
+class RelayClient(object):
+    """Connects to a RelayServer in place of a broker.
+It has the parts of paho's Client interface that MqnEngine and NetworkLoop use (connect, subscribe, unsubscribe, disconnect, the external event loop methods and the callbacks), so an engine configured to use a relay works exactly as it would connected to a broker. Host is the path of the relay's socket; port and keepalive are ignored.
+    """
+    def __init__(self):
+        self.conn = None
+        self.userdata = None
+        self.next_mid = 1
+        self.on_connect = None
+        self.on_disconnect = None
+        self.on_subscribe = None
+        self.on_unsubscribe = None
+        self.on_message = None
+        self.on_socket_open = None
+        self.on_socket_close = None
+        self.on_socket_register_write = None
+
+    def user_data_set(self, userdata):
+        self.userdata = userdata
+
+    def socket(self):
+        return self.conn.sock if self.conn != None else None
+
+    def want_write(self):
+        return self.conn != None and self.conn.want_write()
+
+    def connect(self, host, port=None, keepalive=None):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(host)
+        except socket.error:
+            sock.close()
+            raise
+        self.conn = LineSocket(sock)
+        if self.on_socket_open != None:
+            self.on_socket_open(self, self.userdata, sock)
+
+    def send(self, obj):
+        self.conn.send(encode(obj))
+        if self.on_socket_register_write != None:
+            self.on_socket_register_write(self, self.userdata, self.conn.sock)
+
+    def _mid(self):
+        mid = self.next_mid
+        self.next_mid = self.next_mid % 65535 + 1
+        return mid
+
+    def subscribe(self, topics, qos=0):
+        if not isinstance(topics, list):
+            topics = [(topics, qos)]
+        if self.conn == None:
+            return 4, None # paho's MQTT_ERR_NO_CONN
+        mid = self._mid()
+        self.send({"op": "subscribe", "mid": mid, "topics": [list(t) for t in topics]})
+        return 0, mid
+
+    def unsubscribe(self, topics):
+        if not isinstance(topics, list):
+            topics = [topics]
+        if self.conn == None:
+            return 4, None
+        mid = self._mid()
+        self.send({"op": "unsubscribe", "mid": mid, "topics": topics})
+        return 0, mid
+
+    def disconnect(self):
+        self.close(0)
+
+    def close(self, rc):
+        if self.conn == None:
+            return
+        sock = self.conn.sock
+        self.conn.close()
+        self.conn = None
+        if self.on_socket_close != None:
+            self.on_socket_close(self, self.userdata, sock)
+        if self.on_disconnect != None:
+            self.on_disconnect(self, self.userdata, rc)
+
+    def loop_read(self):
+        if self.conn == None:
+            return
+        try:
+            messages = self.conn.read()
+        except EOFError:
+            self.close(1) # the relay went away
+            return
+        for m in messages:
+            op = m.get('op', None)
+            if op == "connack" and self.on_connect != None:
+                self.on_connect(self, self.userdata, {}, m['rc'])
+            elif op == "suback" and self.on_subscribe != None:
+                self.on_subscribe(self, self.userdata, m['mid'], tuple(m['granted']))
+            elif op == "unsuback" and self.on_unsubscribe != None:
+                self.on_unsubscribe(self, self.userdata, m['mid'])
+            elif op == "message" and self.on_message != None:
+                self.on_message(self, self.userdata, RelayMessage(m['topic'], base64.b64decode(m['payload']), m['qos'], m['retain']))
+            if self.conn == None: # a callback disconnected
+                return
+
+    def loop_write(self):
+        if self.conn == None:
+            return
+        try:
+            self.conn.write()
+        except EOFError:
+            self.close(1)
+
+    def loop_misc(self):
+        pass
@@ -0,0 +1,229 @@
+# per-topic notification rules
+
+import re
+import string
+import time
+from collections import OrderedDict
+
+# rule priorities by name; higher ones are shown first when more are waiting than fit in a batch
+priorities = {"low": -1, "normal": 0, "high": 1}
+actions = ("show", "drop")
+
+MISSING = object() # a field the notification doesn't have
+text_type = type(u"")
+string_types = (str, text_type)
+try:
+    number_types = (int, long, float)
+except NameError: # python 3
+    number_types = (int, float)
+
+
+def get_field(m, path):
+    """Look up a field in a notification by its path (a tuple of keys, from a dotted name like data.host)."""
+    for key in path:
+        if not isinstance(m, dict) or key not in m:
+            return MISSING
+        m = m[key]
+    return m
+
+def hashable(value):
+    try:
+        hash(value)
+        return True
+    except TypeError:
+        return False
+
+def parse_quiet_hours(spec):
+    """Parse "HH:MM-HH:MM" (or a list of them) into a list of (start, end) minutes of the day. A window can wrap past midnight."""
+    if not isinstance(spec, list):
+        spec = [spec]
+    windows = []
+    for s in spec:
+        if not isinstance(s, string_types):
+            raise ValueError("quiet_hours must be a string like \"22:00-07:00\" or a list of them")
+        m = re.match(r'^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$', s)
+        if m == None or int(m.group(1)) > 23 or int(m.group(3)) > 23 or int(m.group(2)) > 59 or int(m.group(4)) > 59:
+            raise ValueError("quiet_hours must look like \"22:00-07:00\", not \"{}\"".format(s))
+        windows.append((int(m.group(1)) * 60 + int(m.group(2)), int(m.group(3)) * 60 + int(m.group(4))))
+    return windows
+
+
+def parse_key_field(name):
+    """Turn a field in a suppression key template, named like data.host or data[host] (the same fields match and regex take), into a path. Raises ValueError for anything else, like attribute access or positional fields."""
+    m = re.match(r'^([^.\[\]]+)(.*)$', name)
+    if m == None or m.group(1).isdigit():
+        raise ValueError("\"{{{}}}\" isn't a notification field; name fields like {{title}}, {{data.host}} or {{data[host]}}".format(name))
+    path, rest = [m.group(1)], m.group(2)
+    while rest:
+        m = re.match(r'^(?:\.([^.\[\]]+)|\[([^\[\]]+)\])', rest)
+        if m == None:
+            raise ValueError("\"{{{}}}\" isn't a notification field; name fields like {{title}}, {{data.host}} or {{data[host]}}".format(name))
+        path.append(m.group(1) if m.group(1) != None else m.group(2))
+        rest = rest[m.end():]
+    return tuple(path)
+
+
+class KeyFormatter(string.Formatter):
+    """Fills in suppression key templates, looking fields up by path like match does, and leaving fields the notification doesn't have empty rather than failing."""
+    def get_field(self, field_name, args, kwargs):
+        value = get_field(kwargs, parse_key_field(field_name))
+        return ("" if value is MISSING else value), field_name
+
+key_formatter = KeyFormatter()
+
+
+class Rule(object):
+    """One [[topic."...".rule]] from config, compiled.
+A rule applies to a notification when every field in match equals its value (or one of them, if the value is a list), and every field in regex matches its pattern. Fields are named like a.b for nested ones.
+Its action decides whether the notification is shown at all; priority orders it against others waiting to be shown; during quiet_hours it's only recorded in the history (unless its priority is high); and if suppress_key is set, notifications giving the same key within suppress_ttl seconds of the first are only shown once.
+    """
+    def __init__(self, options):
+        if not isinstance(options, dict):
+            raise ValueError("each rule must be a table")
+        for name in ('match', 'regex'):
+            if not isinstance(options.get(name, {}), dict):
+                raise ValueError("{} must be a table of fields, like {} = {{ severity = \"error\" }}".format(name, name))
+        self.equals = [] # (path, list of acceptable values)
+        for field, value in options.get('match', {}).items():
+            self.equals.append((tuple(field.split('.')), value if isinstance(value, list) else [value]))
+        self.regexes = [] # (path, compiled pattern)
+        for field, pattern in options.get('regex', {}).items():
+            if not isinstance(pattern, string_types):
+                raise ValueError("the regex for {} must be a string".format(field))
+            try:
+                self.regexes.append((tuple(field.split('.')), re.compile(pattern)))
+            except re.error as e:
+                raise ValueError("the regex for {} (\"{}\") is invalid: {}".format(field, pattern, e))
+        self.action = options.get('action', "show")
+        if not isinstance(self.action, string_types) or self.action not in actions:
+            raise ValueError("action must be one of {}, not \"{}\"".format(", ".join(actions), self.action))
+        priority = options.get('priority', "normal")
+        if not isinstance(priority, string_types) or priority not in priorities:
+            raise ValueError("priority must be one of low, normal or high, not \"{}\"".format(priority))
+        self.priority = priorities[priority]
+        self.quiet_hours = parse_quiet_hours(options['quiet_hours']) if 'quiet_hours' in options else []
+        self.suppress_key = options.get('suppress_key', None)
+        if self.suppress_key != None:
+            if not isinstance(self.suppress_key, string_types):
+                raise ValueError("suppress_key must be a string, like \"{title}\"")
+            try:
+                for text, field, spec, conversion in key_formatter.parse(self.suppress_key):
+                    if field != None:
+                        parse_key_field(field)
+            except ValueError as e:
+                raise ValueError("suppress_key \"{}\" is invalid: {}".format(self.suppress_key, e))
+        self.suppress_ttl = options.get('suppress_ttl', 300)
+        if isinstance(self.suppress_ttl, bool) or not isinstance(self.suppress_ttl, number_types) or self.suppress_ttl <= 0:
+            raise ValueError("suppress_ttl must be a positive number of seconds, not \"{}\"".format(self.suppress_ttl))
+
+    def matches(self, m):
+        for path, values in self.equals: # the cheap checks first
+            if get_field(m, path) not in values:
+                return False
+        for path, pattern in self.regexes:
+            value = get_field(m, path)
+            if value is MISSING or pattern.search(value if isinstance(value, text_type) else u"{}".format(value)) == None:
+                return False
+        return True
+
+    def quiet(self, now):
+        """Return True if now falls in one of this rule's quiet hours windows, and its priority doesn't override them."""
+        if not self.quiet_hours or self.priority >= priorities['high']:
+            return False
+        t = time.localtime(now)
+        minute = t.tm_hour * 60 + t.tm_min
+        for start, end in self.quiet_hours:
+            if (start <= minute < end) if start <= end else (minute >= start or minute < end):
+                return True
+        return False
+
+    def key(self, m):
+        """Return this rule's suppression key for notification m, or None if it doesn't have one (or the notification's fields don't fit the template's format specs)."""
+        if self.suppress_key == None:
+            return None
+        try:
+            return key_formatter.vformat(self.suppress_key, (), m)
+        except (ValueError, TypeError, KeyError, IndexError, AttributeError):
+            return None
+
+
+class RuleSet(object):
+    """A topic's rules, in the order they're given; the first one that applies to a notification decides what happens to it.
+So topics with many rules stay cheap to check, rules are indexed on the field most of them test for equality (like severity): the rules that could apply to each value of it are worked out up front, and only those are checked, still in order.
+    """
+    def __init__(self, rules):
+        self.rules = rules
+        counts = {}
+        for rule in rules:
+            for path, values in rule.equals:
+                if all(hashable(v) for v in values):
+                    counts[path] = counts.get(path, 0) + 1
+        self.key_path = max(counts.keys(), key=lambda p: counts[p]) if counts else None
+        self.buckets = {} # value of key_path -> rules that could apply
+        self.fallback = rules # rules for any other value
+        if self.key_path == None:
+            return
+        indexed = {}
+        unindexed = []
+        for i, rule in enumerate(rules):
+            values = dict(rule.equals).get(self.key_path, None)
+            if values == None or not all(hashable(v) for v in values):
+                unindexed.append(i)
+                continue
+            for v in values:
+                indexed.setdefault(v, []).append(i)
+        self.fallback = [rules[i] for i in unindexed]
+        for v, positions in indexed.items():
+            self.buckets[v] = [rules[i] for i in sorted(set(positions + unindexed))]
+
+    def __len__(self):
+        return len(self.rules)
+
+    def evaluate(self, m):
+        """Return the first rule that applies to notification m, or None if none do."""
+        candidates = self.rules
+        if self.key_path != None:
+            try:
+                candidates = self.buckets.get(get_field(m, self.key_path), self.fallback)
+            except TypeError: # an unhashable value, like a list; no indexed rule can match it
+                candidates = self.fallback
+        for rule in candidates:
+            if rule.matches(m):
+                return rule
+        return None
+
+
+def compile_rules(options):
+    """Build a topic's RuleSet from its list of rule tables in config. Raises ValueError if any of them is invalid."""
+    if not isinstance(options, list):
+        raise ValueError("rules must be given as [[topic.\"name\".rule]] tables")
+    rules = []
+    for i, r in enumerate(options):
+        try:
+            rules.append(Rule(r))
+        except ValueError as e:
+            raise ValueError("rule {}: {}".format(i+1, e))
+    return RuleSet(rules)
+
+
+class SuppressionCache(object):
+    """Remembers suppression keys until their ttl runs out, evicting the least recently seen once it holds max_entries."""
+    def __init__(self, max_entries=1000):
+        self.max_entries = max(1, max_entries)
+        self.entries = OrderedDict() # key -> time it expires, least recently seen first
+
+    def __len__(self):
+        return len(self.entries)
+
+    def seen(self, key, ttl, now=None):
+        """Return True if key was recorded less than its ttl ago, otherwise record it (for ttl seconds) and return False. Repeats don't extend the ttl, so an alert that keeps repeating is still shown once every ttl seconds."""
+        if now is None:
+            now = time.time()
+        expires = self.entries.pop(key, None)
+        if expires != None and expires > now:
+            self.entries[key] = expires # now the most recently seen
+            return True
+        self.entries[key] = now + ttl
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return False
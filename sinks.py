@@ -0,0 +1,91 @@
+# notification sinks for headless mode
+
+import io
+import json
+import subprocess
+import sys
+import time
+
+
+class Sink(object):
+    """Somewhere notifications go when mqn runs without a user interface. Subclasses override notify(), and optionally status() and close()."""
+    def notify(self, title, message, topic=None):
+        raise NotImplementedError
+
+    def status(self, status):
+        pass
+
+    def close(self):
+        pass
+
+
+class StreamSink(Sink):
+    """Writes notifications to a stream, one per line; either as plain text or as json objects (json lines)."""
+    def __init__(self, stream=None, json_lines=False):
+        if stream == None:
+            stream = sys.stdout
+        self.stream = stream
+        self.json_lines = json_lines
+
+    def format(self, kind, title, message, topic):
+        if self.json_lines:
+            return json.dumps({"time": time.time(), "kind": kind, "topic": topic, "title": title, "message": message})
+        if kind == "status":
+            return u"{} status: {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), message)
+        return u"{} [{}] {}: {}".format(time.strftime("%Y-%m-%d %H:%M:%S"), topic or "mqn", title, message)
+
+    def write(self, line):
+        self.stream.write(line + u"\n")
+        self.stream.flush()
+
+    def notify(self, title, message, topic=None):
+        self.write(self.format("notification", title, message, topic))
+
+    def status(self, status):
+        if status != "":
+            self.write(self.format("status", None, status, None))
+
+
+class LogFileSink(StreamSink):
+    """Appends notifications to a log file."""
+    def __init__(self, path, json_lines=False):
+        super(LogFileSink, self).__init__(io.open(path, 'a', encoding='utf-8'), json_lines)
+
+    def close(self):
+        self.stream.close()
+
+
+class LibnotifySink(Sink):
+    """Shows notifications on the desktop through libnotify's notify-send command, without needing wx."""
+    def __init__(self, command="notify-send", app_name="mqn"):
+        self.command = command
+        self.app_name = app_name
+
+    def notify(self, title, message, topic=None):
+        try:
+            subprocess.Popen([self.command, "--app-name", self.app_name, title, message]) # don't wait for it; we'd rather not block on the desktop's notification daemon
+        except OSError as e:
+            sys.stderr.write("Couldn't run {}: {}\n".format(self.command, e))
+
+
+def create_sink(spec):
+    """Create a sink from a command line specification, one of:
+stdout - plain text on standard output
+json - json lines on standard output
+log:path - plain text appended to a file (jsonlog:path for json lines)
+libnotify - desktop notifications through notify-send
+    """
+    kind, sep, arg = spec.partition(':')
+    if kind == "stdout":
+        return StreamSink()
+    elif kind == "json":
+        return StreamSink(json_lines=True)
+    elif kind in ("log", "jsonlog"):
+        if arg == "":
+            raise ValueError("The {} sink needs a path, like {}:/path/to/file".format(kind, kind))
+        return LogFileSink(arg, json_lines=(kind == "jsonlog"))
+    elif kind == "libnotify":
+        if arg != "":
+            return LibnotifySink(command=arg)
+        return LibnotifySink()
+    raise ValueError("Unknown sink '{}'".format(spec))
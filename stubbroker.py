@@ -0,0 +1,197 @@
+# a minimal in-process mqtt broker, for benchmarking mqn without a real one
+
+import socket
+import struct
+import threading
+from paho.mqtt.client import topic_matches_sub
+
+
+def encode_length(n):
+    """Encode n as an mqtt variable length integer."""
+    out = bytearray()
+    while True:
+        b = n % 128
+        n //= 128
+        if n:
+            b |= 0x80
+        out.append(b)
+        if not n:
+            return bytes(out)
+
+def packet(ptype, flags, body):
+    return bytes(bytearray([(ptype << 4) | flags])) + encode_length(len(body)) + body
+
+def mqtt_string(s):
+    if not isinstance(s, bytes):
+        s = s.encode('utf-8')
+    return struct.pack("!H", len(s)) + s
+
+
+class Session(threading.Thread):
+    """One client's connection to the stub broker, read on its own thread."""
+    def __init__(self, broker, sock):
+        super(Session, self).__init__()
+        self.daemon = True
+        self.broker = broker
+        self.sock = sock
+        self.lock = threading.Lock() # messages are delivered from whatever thread publishes them
+        self.subs = {} # topic filter -> qos
+        self.next_mid = 1
+        self.client_id = None
+
+    def recv_exact(self, n):
+        buf = b''
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise EOFError()
+            buf += chunk
+        return buf
+
+    def read_packet(self):
+        h = bytearray(self.recv_exact(1))[0]
+        mult, length = 1, 0
+        while True:
+            b = bytearray(self.recv_exact(1))[0]
+            length += (b & 0x7f) * mult
+            mult *= 128
+            if not b & 0x80:
+                break
+        return h >> 4, h & 0x0f, self.recv_exact(length) if length else b''
+
+    def send(self, data):
+        with self.lock:
+            self.sock.sendall(data)
+
+    def run(self):
+        try:
+            while True:
+                ptype, flags, body = self.read_packet()
+                self.handle(ptype, flags, body)
+        except (EOFError, socket.error, OSError):
+            pass
+        finally:
+            self.broker.remove(self)
+            try:
+                self.sock.close()
+            except socket.error:
+                pass
+
+    def handle(self, ptype, flags, body):
+        if ptype == 1: # CONNECT
+            pos = 2 + struct.unpack("!H", body[:2])[0] + 4 # skip the protocol name, level, flags and keepalive
+            n = struct.unpack("!H", body[pos:pos+2])[0]
+            self.client_id = body[pos+2:pos+2+n]
+            self.send(packet(2, 0, bytes(bytearray([0, self.broker.connack_code]))))
+        elif ptype == 8: # SUBSCRIBE
+            mid = body[:2]
+            pos = 2
+            granted = bytearray()
+            while pos < len(body):
+                n = struct.unpack("!H", body[pos:pos+2])[0]
+                topic = body[pos+2:pos+2+n].decode('utf-8')
+                qos = bytearray(body[pos+2+n:pos+3+n])[0]
+                pos += 3 + n
+                if topic in self.broker.refuse:
+                    granted.append(0x80)
+                else:
+                    self.subs[topic] = qos
+                    granted.append(qos)
+            self.send(packet(9, 0, mid + bytes(granted)))
+        elif ptype == 10: # UNSUBSCRIBE
+            mid = body[:2]
+            pos = 2
+            while pos < len(body):
+                n = struct.unpack("!H", body[pos:pos+2])[0]
+                self.subs.pop(body[pos+2:pos+2+n].decode('utf-8'), None)
+                pos += 2 + n
+            self.send(packet(11, 0, mid))
+        elif ptype == 3: # PUBLISH
+            qos = (flags >> 1) & 3
+            n = struct.unpack("!H", body[:2])[0]
+            topic = body[2:2+n].decode('utf-8')
+            pos = 2 + n
+            if qos:
+                mid = body[pos:pos+2]
+                pos += 2
+                self.send(packet(4 if qos == 1 else 5, 0, mid))
+            self.broker.publish(topic, body[pos:], qos)
+        elif ptype == 12: # PINGREQ
+            self.send(packet(13, 0, b''))
+        elif ptype == 14: # DISCONNECT
+            raise EOFError()
+
+    def deliver(self, topic, payload, qos):
+        for f, subqos in list(self.subs.items()):
+            if topic_matches_sub(f, topic):
+                q = min(qos, subqos, 1) # qos 2 is delivered as qos 1; mqn treats them the same
+                body = mqtt_string(topic)
+                if q:
+                    body += struct.pack("!H", self.next_mid)
+                    self.next_mid = self.next_mid % 65535 + 1
+                self.send(packet(3, q << 1, body + payload))
+                return
+
+
+class StubBroker(object):
+    """Just enough of an mqtt 3.1.1 broker to connect mqn to on the loopback interface.
+It accepts every connection (answering with connack_code), grants every subscription except topics in refuse, and delivers whatever is passed to publish() to matching subscribers. There are no sessions, retained messages or acknowledgement tracking.
+    """
+    def __init__(self, host="127.0.0.1", port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(64)
+        self.host, self.port = self.sock.getsockname()
+        self.sessions = []
+        self.lock = threading.Lock()
+        self.connack_code = 0
+        self.refuse = set()
+        self.thread = threading.Thread(target=self.accept_loop, name="stub broker")
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def accept_loop(self):
+        while True:
+            try:
+                s, addr = self.sock.accept()
+            except (socket.error, OSError):
+                return
+            sess = Session(self, s)
+            with self.lock:
+                self.sessions.append(sess)
+            sess.start()
+
+    def remove(self, sess):
+        with self.lock:
+            if sess in self.sessions:
+                self.sessions.remove(sess)
+
+    def publish(self, topic, payload, qos=0):
+        """Deliver a message to every connected client subscribed to topic."""
+        if not isinstance(payload, bytes):
+            payload = payload.encode('utf-8')
+        with self.lock:
+            sessions = list(self.sessions)
+        for s in sessions:
+            try:
+                s.deliver(topic, payload, qos)
+            except (socket.error, OSError):
+                pass
+
+    def drop_clients(self):
+        """Cut every client off without a DISCONNECT, like a broker restart or a network failure."""
+        with self.lock:
+            sessions = list(self.sessions)
+        for s in sessions:
+            try:
+                s.sock.shutdown(socket.SHUT_RDWR)
+            except (socket.error, OSError):
+                pass
+
+    def stop(self):
+        self.drop_clients()
+        self.sock.close()
@@ -0,0 +1,132 @@
+# subscription request pipelining
+
+import random
+import time
+from collections import OrderedDict
+
+# the granted qos a broker returns in a SUBACK for a topic it refused
+SUBACK_FAILURE = 0x80
+
+
+class SubscriptionPipeline(object):
+    """Splits subscriptions into SUBSCRIBE requests of at most chunk_size topics, with no more than window requests waiting on the broker at once.
+Each topic's granted qos is checked when the broker answers; refused topics, and those in requests that went unanswered for timeout seconds, are retried with exponential backoff (between retry_min and retry_max seconds) up to max_retries times.
+The pipeline only decides what to send; the caller sends each chunk from next_chunks() and reports back through sent() and acknowledged().
+    """
+    def __init__(self, chunk_size=100, window=4, timeout=30, max_retries=5, retry_min=1, retry_max=120):
+        self.chunk_size = max(1, chunk_size)
+        self.window = max(1, window)
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.retry_min = retry_min
+        self.retry_max = retry_max
+        self.reset()
+
+    def reset(self):
+        """Forget everything queued and in flight; called when the connection closes."""
+        self.queue = OrderedDict() # topic -> qos, waiting to be sent
+        self.in_flight = OrderedDict() # mid -> (time sent, [(topic, qos), ...])
+        self.retrying = {} # topic -> (qos, time it's due)
+        self.attempts = {} # topic -> failed attempts so far
+        self.started = None
+        self.time_to_subscribed = None # seconds from start() until every topic was granted or given up on
+        self.given_up = []
+        self.timed_out = [] # mids of requests given up on waiting for, for the caller to forget
+
+    def start(self, subtuples, now=None):
+        """Begin subscribing to a fresh connection's whole list of (topic, qos) tuples, timing how long it takes."""
+        if now is None:
+            now = time.time()
+        self.reset()
+        self.started = now
+        self.add(subtuples)
+
+    def add(self, subtuples):
+        """Queue more (topic, qos) tuples to subscribe to."""
+        for topic, qos in subtuples:
+            self.queue[topic] = qos
+            self.retrying.pop(topic, None)
+
+    def discard(self, topics):
+        """Stop subscribing to topics: drop them from the queue and the retry list. Returns those of them in requests still in flight, which the broker may yet grant."""
+        topics = set(topics)
+        for topic in topics:
+            self.queue.pop(topic, None)
+            self.retrying.pop(topic, None)
+            self.attempts.pop(topic, None)
+        return [topic for sent, chunk in self.in_flight.values() for topic, qos in chunk if topic in topics]
+
+    @property
+    def busy(self):
+        return bool(self.queue or self.in_flight or self.retrying)
+
+    def next_chunks(self, now=None):
+        """Return a list of chunks (lists of (topic, qos) tuples) to send now, each as its own SUBSCRIBE request."""
+        if now is None:
+            now = time.time()
+        for topic, (qos, due) in list(self.retrying.items()):
+            if due <= now:
+                del(self.retrying[topic])
+                self.queue[topic] = qos
+        for mid, (sent, chunk) in list(self.in_flight.items()):
+            if now - sent >= self.timeout: # the broker never answered; try these again
+                del(self.in_flight[mid])
+                self.timed_out.append(mid)
+                for topic, qos in chunk:
+                    self.failed(topic, qos, now)
+        chunks = []
+        while self.queue and len(self.in_flight) + len(chunks) < self.window:
+            chunk = []
+            while self.queue and len(chunk) < self.chunk_size:
+                chunk.append(self.queue.popitem(last=False))
+            chunks.append(chunk)
+        if not chunks: # anything returned isn't in flight until sent() is called
+            self.check_done(now)
+        return chunks
+
+    def sent(self, mid, chunk, now=None):
+        """Record that chunk was sent as the SUBSCRIBE request with message id mid."""
+        if now is None:
+            now = time.time()
+        self.in_flight[mid] = (now, chunk)
+
+    def acknowledged(self, mid, granted_qos, now=None):
+        """Handle the broker's SUBACK for mid. Returns a tuple of (granted topics, refused topics); it's empty if mid isn't one of ours (or timed out already)."""
+        if now is None:
+            now = time.time()
+        if mid not in self.in_flight:
+            return [], []
+        sent, chunk = self.in_flight.pop(mid)
+        granted, refused = [], []
+        for (topic, qos), g in zip(chunk, granted_qos):
+            if g == SUBACK_FAILURE:
+                refused.append(topic)
+                self.failed(topic, qos, now)
+            else:
+                granted.append(topic)
+                self.attempts.pop(topic, None)
+        self.check_done(now)
+        return granted, refused
+
+    def check_done(self, now):
+        if self.started != None and self.time_to_subscribed == None and not self.busy:
+            self.time_to_subscribed = now - self.started
+
+    def failed(self, topic, qos, now):
+        attempts = self.attempts.get(topic, 0) + 1
+        self.attempts[topic] = attempts
+        if attempts > self.max_retries:
+            self.given_up.append(topic)
+            return
+        cap = min(self.retry_max, self.retry_min * 2 ** attempts)
+        self.retrying[topic] = (qos, now + random.uniform(cap / 2.0, cap))
+
+    def next_due(self):
+        """Return when next_chunks() next needs calling for a retry or a timeout, or None if nothing is waiting on time."""
+        times = [due for qos, due in self.retrying.values()] + [sent + self.timeout for sent, chunk in self.in_flight.values()]
+        if not times:
+            return None
+        return min(times)
+
+    def stats(self):
+        return {"queued": len(self.queue), "in_flight": len(self.in_flight), "retrying": len(self.retrying), "given_up": len(self.given_up), "time_to_subscribed": self.time_to_subscribed}
@@ -0,0 +1,77 @@
+# a trie of mqtt topic filters
+
+
+class TopicTrie(object):
+    """Maps mqtt topic filters (which can contain + and # wildcards) to values, and finds every filter matching a topic in time proportional to the topic's depth rather than the number of filters.
+Filters are split into levels on '/', so 'a/+/c' is stored as a -> + -> c.
+    """
+    def __init__(self, filters=None):
+        self.root = {}
+        self.count = 0
+        if filters != None:
+            for f, value in filters.items():
+                self.add(f, value)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, topic_filter, value):
+        """Add topic_filter to the trie, replacing the value if it is already present."""
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.setdefault(level, {})
+        if None not in node:
+            self.count += 1
+        node[None] = (topic_filter, value) # the None key holds the filter ending at this node; levels are always strings
+
+    def remove(self, topic_filter):
+        """Remove topic_filter from the trie, pruning any nodes left empty. Returns the removed value, or None if it wasn't present."""
+        path = [self.root]
+        for level in topic_filter.split('/'):
+            node = path[-1].get(level, None)
+            if node == None:
+                return None
+            path.append(node)
+        if None not in path[-1]:
+            return None
+        value = path[-1].pop(None)[1]
+        self.count -= 1
+        levels = topic_filter.split('/')
+        for i in range(len(levels), 0, -1):
+            if path[i]:
+                break
+            del(path[i-1][levels[i-1]])
+        return value
+
+    def get(self, topic_filter, default=None):
+        """Return the value stored for exactly topic_filter (not a topic match)."""
+        node = self.root
+        for level in topic_filter.split('/'):
+            node = node.get(level, None)
+            if node == None:
+                return default
+        if None not in node:
+            return default
+        return node[None][1]
+
+    def match(self, topic):
+        """Return a list of (filter, value) tuples for every filter in the trie that matches topic, most specific first.
+Filters are compared level by level from the left, and at the first level where they differ, an exact level beats '+', which beats '#'; so for 'alerts/db', 'alerts/db' comes before 'alerts/+', which comes before 'alerts/#'.
+        """
+        matches = []
+        # per the mqtt spec, wildcards at the first level don't match topics starting with $ (like $SYS)
+        self._match(self.root, topic.split('/'), 0, matches, topic.startswith('$'))
+        return matches
+
+    def _match(self, node, levels, i, matches, dollar):
+        wildcards = not (dollar and i == 0)
+        if i == len(levels):
+            if None in node:
+                matches.append(node[None])
+        else:
+            if levels[i] in node:
+                self._match(node[levels[i]], levels, i+1, matches, dollar)
+            if wildcards and '+' in node:
+                self._match(node['+'], levels, i+1, matches, dollar)
+        if wildcards and '#' in node and None in node['#']: # '#' also matches the parent level, so 'a/#' matches 'a'
+            matches.append(node['#'][None])
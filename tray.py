@@ -0,0 +1,212 @@
+# the system tray interface for mqn
+# author: Blake Oliver <oliver22213@me.com>
+
+import io
+import os
+import time
+import webbrowser
+import wx
+from wx import App
+from wx.adv import TaskBarIcon
+from engine import MqnEngine, ConfigError
+from icons import LRUCache
+
+
+def create_menu_item(menu, label, func, id=None, help="", kind=wx.ITEM_NORMAL, bind_to=None):
+    """A quick function to add and bind a menu item.
+            The point of this is to provide a wrapper around WX and be called by the application with all the arguments it needs (and with defaults that you can just not worry about if you don't need them). It will also handle binding to a menu event.
+            This can be used for menubars, system tray icons, etc.
+            Necessary info is the menu object in question, a label for your new option, and a funcion you'd like to bind it to. You can also provide a help text, the kind, and an ID, if your making a stock item (about, exit, new), it's best to use those so they look native on every OS.
+            Kind can be one of:
+                    wx.ITEM_SEPARATOR - a line in the menu separating items
+                    wx.ITEM_NORMAL - a normal clickable menu item (this is what is used if you don't specify a kind)
+                    wx.ITEM_CHECK - a checkable menu item, use item.Check(True), or item.Check(False) to control this
+                    wx.ITEM_RADIO - (I think...), an item that is exclusively checked. (You have 5 items, you can only have one checked)
+            By default, this function appends your item to the end of the menu, so the order in which you add items by calling this function is important to how the menu looks.
+            Also, remember you can denote a shortcut key with the and (&) sign before the letter in the label.
+            Coppied and slightly modified from http://stackoverflow.com/questions/6389580/quick-and-easy-trayicon-with-python
+    """
+    if id is None:
+        id = wx.ID_ANY
+    item = wx.MenuItem(menu, id, label, help, kind)
+    if bind_to == None: # bind to the menu by default
+        menu.Bind(wx.EVT_MENU, func, id=item.GetId())
+    else:
+        bind_to.Bind(wx.EVT_MENU, func, id=item.GetId())
+    menu.Append(item)
+    return item
+
+
+class Mqn(TaskBarIcon, MqnEngine):
+    def __init__(self, icon_name):
+        TaskBarIcon.__init__(self)
+        self.icon_name = icon_name
+        self.SetIcon(wx.NullIcon, self.icon_name)
+        self.balloon_icons = LRUCache() # icon digest -> decoded wx.Icon (or None if it couldn't be), only touched on the UI thread
+        MqnEngine.__init__(self)
+        self.dispatch_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_dispatch_timer, self.dispatch_timer)
+        self.dispatch_timer.Start(self.config['mqn']['dispatch_interval'])
+        self.config_timer = wx.Timer(self)
+        self.Bind(wx.EVT_TIMER, self.on_config_timer, self.config_timer)
+        self.setup_config_watch()
+
+    def setup_config_watch(self):
+        """Start or stop checking the configuration file for changes, according to the watch_config option."""
+        self.config_timer.Stop()
+        if self.config['mqn']['watch_config'] == True:
+            self.config_timer.Start(int(self.config['mqn']['watch_interval'] * 1000))
+
+    def on_config_timer(self, event=None):
+        try:
+            if self.check_config():
+                self.setup_config_watch()
+                if self.config['mqn']['quiet'] == False and self.muted == False:
+                    self.notify("Configuration reloaded", "Changes to {} have been applied.".format(self.config_file))
+        except ConfigError as e:
+            # the file may just be half-way through being edited, so don't interrupt with a dialog
+            self.notify(e.caption, e.message+"\nThe previous configuration is still being used.")
+
+    def on_dispatch_timer(self, event=None):
+        """Show whatever notifications have been queued since the last tick. Runs on the UI thread."""
+        self.dispatch_pending()
+
+    def notify(self, title, message, topic=None, icon=None):
+        # this can be called from the mqtt network thread, and wx should only be touched from the UI thread
+        wx.CallAfter(self.show_balloon, title, message, icon)
+
+    def show_balloon(self, title, message, icon=None):
+        balloon_icon = self.get_balloon_icon(icon) if icon != None else None
+        if balloon_icon == None:
+            self.ShowBalloon(title, message)
+            return
+        try:
+            self.ShowBalloon(title, message, icon=balloon_icon)
+        except TypeError: # wxPython before 4.1 can't give balloons their own icon
+            self.ShowBalloon(title, message)
+
+    def get_balloon_icon(self, digest):
+        """Return the wx.Icon for an icon in the icon cache, decoding it the first time it's shown. Returns None if it isn't cached or isn't an image wx can read."""
+        if digest in self.balloon_icons:
+            return self.balloon_icons.get(digest)
+        data = self.icon_cache.get(digest)
+        if data == None:
+            return None # not remembered as a failure, in case it's sent again
+        no_log = wx.LogNull() # don't pop up wx's own error dialog for an unreadable image
+        image = wx.Image(io.BytesIO(data))
+        del no_log
+        icon = None
+        if image.IsOk():
+            largest = max(image.GetWidth(), image.GetHeight())
+            if largest > 32: # balloons show icons small; scaling down once here is cheaper than every time one's shown
+                image = image.Scale(max(1, image.GetWidth() * 32 // largest), max(1, image.GetHeight() * 32 // largest), wx.IMAGE_QUALITY_HIGH)
+            icon = wx.Icon()
+            icon.CopyFromBitmap(wx.Bitmap(image))
+        self.balloon_icons.max_entries = max(1, self.config['mqn']['icon_cache_size']) # follows config reloads
+        self.balloon_icons.put(digest, icon)
+        return icon
+
+    def CreatePopupMenu(self):
+        menu = wx.Menu()
+        create_menu_item(menu, "connect", self.do_menu_connect, kind=wx.ITEM_CHECK).Check(self.mqtt_connected) # if we're connected to the broker, this is checked
+        create_menu_item(menu, "mute notifications", self.toggle_mute, kind=wx.ITEM_CHECK).Check(self.muted)
+        topics_submenu = wx.Menu()
+        for subname, sub in self.mqtt_subscriptions.iteritems():
+            create_menu_item(topics_submenu, subname, self.on_menu_toggle_subscription, bind_to=menu, kind=wx.ITEM_CHECK).Check(sub['subscribed'])
+        menu.AppendSubMenu(topics_submenu, "topics").Enable(self.mqtt_connected)
+        recent_submenu = wx.Menu()
+        recent = self.history.recent(self.config['mqn']['history_recent']) if self.history != None else []
+        for n in recent:
+            label = "{} {}: {}".format(time.strftime("%H:%M", time.localtime(n['time'])), n['subscription'], n['title']).replace("&", "&&")
+            create_menu_item(recent_submenu, label, lambda event, n=n: self.show_history_entry(n), bind_to=menu)
+        menu.AppendSubMenu(recent_submenu, "recent notifications").Enable(len(recent) > 0)
+        stats = self.dispatch_queue.stats()
+        menu.Append(wx.ID_ANY, "queued: {depth}, held: {held}, dropped: {dropped}".format(**stats)).Enable(False)
+        create_menu_item(menu, "&statistics", self.on_menu_statistics)
+        create_menu_item(menu, "open configuration file", self.open_config)
+        create_menu_item(menu, "&reload configuration file", self.on_menu_reload_config)
+        create_menu_item(menu, "open mqn &website", self.open_website)
+        create_menu_item(menu, "e&xit", self.on_exit)
+        return menu
+
+    def set_status(self, status=""):
+        """Method that sets a small status message next to the icon's name in the system tray.
+If status is an empty string (which is the default), then set the name of the icon to what this class was instantiated with.
+        """
+        self.status = status
+        wx.CallAfter(self._set_icon_status, status) # may be called from the mqtt network thread
+
+    def _set_icon_status(self, status):
+        try:
+            if status == '':
+                self.SetIcon(wx.NullIcon, self.icon_name)
+            else:
+                self.SetIcon(wx.NullIcon, """{}: {}""".format(self.icon_name, status))
+        except RuntimeError as e:
+            pass
+
+    def do_menu_connect(self, event=None):
+        """Connect or disconnect from the configured mqtt broker."""
+        # no matter what the menu item's checked status says, this method will properly open or close a connection to the configured broker
+        # I do it this way because (unlikely though it is), the connection status can change while a menu is open;
+        # so if this method acts based on that, it could run connect (when there is already one established), and cause a reconnect, which would require another usage of this method to fix
+        # or it could run disconnect, when there is no connection to the broker, thus doing nothing
+        if self.mqtt_connected == True: # disconnect
+            self.mqtt_disconnect()
+        elif self.mqtt_connected == False: # connect
+            self.mqtt_connect()
+
+    def toggle_mute(self, event):
+        self.muted = not self.muted
+
+    def on_menu_toggle_subscription(self, event):
+        self.toggle_subscription(event.GetEventObject().FindItemById(event.GetId()).GetItemLabelText())
+
+    def show_history_entry(self, n):
+        wx.MessageDialog(parent=None, caption=n['title'], message="{}\n\n{} on {}".format(n['message'], time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(n['time'])), n['topic'])).ShowModal()
+
+    def on_menu_statistics(self, event=None):
+        wx.MessageDialog(parent=None, caption="mqn statistics", message="\n".join(self.statistics())).ShowModal()
+
+    def open_website(self, event=None):
+        webbrowser.open("https://github.com/oliver2213/mqn")
+
+    def open_config(self, event=None):
+        os.startfile(self.config_file)
+
+    def on_menu_reload_config(self, event=None):
+        try:
+            reconnected = self.reload_config()
+        except ConfigError as e:
+            wx.MessageDialog(parent=None, caption=e.caption, message=e.message+"\nThe previous configuration is still being used.").ShowModal()
+            return
+        self.setup_config_watch()
+        if reconnected:
+            wx.MessageDialog(parent=None, caption="config reloaded", message="The configuration file has been reloaded and the connection to your configured mqtt broker is being reestablished according to the updated config.").ShowModal()
+        else:
+            wx.MessageDialog(parent=None, caption="config reloaded", message="The configuration file has been reloaded, and any topic changes have been applied without reconnecting.").ShowModal()
+
+    def on_exit(self, event=None):
+        self.dispatch_timer.Stop()
+        self.config_timer.Stop()
+        self.shutdown() # will only disconnect if it needs doing, and stops mqtt's loop as well if necessary
+        wx.CallAfter(self.Destroy)
+
+def main():
+    m = None
+    app = App()
+    try:
+        m = Mqn("mqn")
+        app.MainLoop()
+    except ConfigError as e:
+        wx.MessageDialog(parent=None, caption=e.caption, message=e.message).ShowModal()
+        return
+    except Exception as e:
+        #print("""Unhandled exception:\n{}""".format(str(e)))
+        #raise
+        wx.MessageDialog(parent=None, caption="Error!", message="""{}: {}""".format(type(e).__name__, e)).ShowModal()
+        return
+    finally:
+        # gracefully disconnect, even if an exception is thrown
+        if m != None and getattr(m, 'client', False) and m.mqtt_connected==True: # if there is an mqn object, if it has an mqtt client, and it indicates that it is still connected to a broker
+            m.mqtt_disconnect()